@@ -1,4 +1,5 @@
 from enum import Enum
+from weakref import WeakKeyDictionary
 import os
 import socket
 import struct
@@ -8,6 +9,7 @@ import json
 MAGIC = 'i3-ipc'
 HEADER = '=%dsII' % len(MAGIC.encode('utf-8'))
 HEADER_SIZE = struct.calcsize(HEADER)
+READ_BUFFER_SIZE = 64 * 1024
 
 
 class MessageType(Enum):
@@ -56,14 +58,68 @@ def unpack(data):
     return payload.decode('utf-8', 'replace')
 
 
+class FrameReader(object):
+    """Reads i3-ipc messages from a socket into a reusable buffer,
+    bytes past the end of a message are kept for the next one.
+    """
+
+    def __init__(self, sock, size=READ_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def fill(self, size):
+        while self.end - self.start < size:
+            if self.start + size > len(self.buffer):
+                pending = self.end - self.start
+                source = memoryview(self.buffer)[self.start:self.end]
+                if size > len(self.buffer):
+                    self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+                memoryview(self.buffer)[:pending] = source
+                self.start = 0
+                self.end = pending
+            received = self.sock.recv_into(memoryview(self.buffer)[self.end:])
+            if received == 0:
+                return False
+            self.end += received
+        return True
+
+    def read_frame(self):
+        if not self.fill(HEADER_SIZE):
+            return None
+        msg_magic, msg_length, msg_type = struct.unpack_from(
+            HEADER, self.buffer, self.start)
+        if msg_magic != MAGIC.encode('utf-8'):
+            raise ValueError('Invalid i3-ipc message header')
+        if not self.fill(HEADER_SIZE + msg_length):
+            return None
+        payload_start = self.start + HEADER_SIZE
+        payload_end = payload_start + msg_length
+        payload = str(
+            memoryview(self.buffer)[payload_start:payload_end],
+            'utf-8',
+            'replace',
+        )
+        if payload_end == self.end:
+            self.start = self.end = 0
+        else:
+            self.start = payload_end
+        return msg_type, payload
+
+
+_readers = WeakKeyDictionary()
+
+
 def read(sock):
-    data = sock.recv(14)
-    msg_magic, msg_length, msg_type = unpack_header(data)
-    msg_size = HEADER_SIZE + msg_length
-    while len(data) < msg_size:
-        data += sock.recv(msg_length)
-    payload = unpack(data)
-    return json.loads(payload)
+    reader = _readers.get(sock, None)
+    if reader is None:
+        reader = FrameReader(sock)
+        _readers[sock] = reader
+    frame = reader.read_frame()
+    if frame is None:
+        raise ConnectionError('The IPC socket is closed')
+    return json.loads(frame[1])
 
 
 def get_workspaces(sock):
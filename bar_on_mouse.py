@@ -5,6 +5,8 @@ import time
 from Xlib import display, X, protocol
 from Xlib.ext import record, xtest
 
+import wm_ipc
+
 
 BAR_POSITION = 'bottom'
 SAFE_AREA_MULT = 2.5
@@ -19,6 +21,9 @@ LEFT_KEYSYM = 0xff51
 RIGHT_KEYSYM = 0xff53
 ALT_L_KEYSYM = 0xffe9
 SHIFT_L_KEYSYM = 0xffe1
+# show and hide the bar with "bar hidden_state" over the i3 IPC socket
+# instead of emulating Num Lock, the bar doesn't need the Mod2 modifier
+BAR_IPC = False
 
 
 def find_bar(display_arg):
@@ -48,6 +53,16 @@ def send_numlock():
     send_key_event(numlock_keycode, X.KeyRelease)
 
 
+def toggle_bar(show):
+    if not BAR_IPC:
+        send_numlock()
+        return
+    try:
+        ipc.command('bar hidden_state %s' % ('show' if show else 'hide'))
+    except (OSError, ValueError) as e:
+        print('Cant toggle the bar: %s' % e)
+
+
 def handler(reply):
     global bar_is_visible
     global bar_hiding_started
@@ -62,7 +77,7 @@ def handler(reply):
             and event.type == X.KeyPress
             and (event.state & MODIFIER_MASK) == MODIFIER_MASK
             and event.detail in arrow_keycodes):
-            send_numlock()
+            toggle_bar(True)
             bar_is_visible = True
             continue
 
@@ -71,7 +86,7 @@ def handler(reply):
             and (event.state & MODIFIER_MASK) < MODIFIER_MASK
             and event.detail in mod_keycodes
             and bar_test(event.root_y)):
-            send_numlock()
+            toggle_bar(False)
             bar_is_visible = False
             continue
 
@@ -79,12 +94,12 @@ def handler(reply):
             continue
 
         if not bar_is_visible and event.root_y == edge:
-            send_numlock()
+            toggle_bar(True)
             bar_is_visible = True
             continue
 
         if bar_is_visible and bar_test(event.root_y):
-            send_numlock()
+            toggle_bar(False)
             bar_is_visible = False
 
 
@@ -109,6 +124,7 @@ if __name__ == '__main__':
         display_glob.keysym_to_keycode(SHIFT_L_KEYSYM)
     ]
     bar_is_visible = False
+    ipc = wm_ipc.IPCClient()
 
     display_glob.flush()
     display_glob.sync()
@@ -0,0 +1,105 @@
+#! /usr/bin/env python3
+"""Construction time and memory of the i3ipc.Con tree.
+
+Builds Con trees from a parsed GET_TREE reply of a synthetic tree with
+2,000 containers and measures the construction, the lookups the daemon
+does and the memory held by the tree, before and after all the
+containers are materialized, and the find_* queries repeated on one
+tree.
+
+    python bench/bench_con.py
+    python bench/bench_con.py --sizes 2000 10000 --repeat 50
+"""
+from typing import Any, Callable
+import os
+import sys
+import argparse
+import json
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'i3patch'))
+
+import i3ipc  # noqa: E402
+from fake_ipc import synthetic_tree, count_containers  # noqa: E402
+from bench_ipc import measure, print_table  # noqa: E402
+
+
+def build(payload: str) -> Any:
+    return i3ipc.Con(json.loads(payload), None, None)
+
+
+def materialize(tree: Any) -> Any:
+    tree.descendents()
+    return tree
+
+
+def traced(fn: Callable[[], Any]) -> tuple[Any, float]:
+    """Returns the result of the call and the KB it keeps allocated."""
+    tracemalloc.start()
+    result = fn()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current / 1024
+
+
+def bench_con(sizes: list[int], repeat: int) -> None:
+    print('i3ipc.Con tree, median ms and KB held')
+    rows = []
+    for size in sizes:
+        payload = json.dumps(synthetic_tree(size))
+        parse, _ = measure(lambda: json.loads(payload), repeat)
+        construct, _ = measure(lambda: build(payload), repeat)
+        focused, _ = measure(lambda: build(payload).find_focused(), repeat)
+        full, _ = measure(lambda: build(payload).descendents(), repeat)
+        _, held = traced(lambda: build(payload))
+        _, held_all = traced(lambda: materialize(build(payload)))
+        rows.append([
+            count_containers(json.loads(payload)),
+            f'{parse:.2f}',
+            f'{construct:.2f}',
+            f'{focused:.2f}',
+            f'{full:.2f}',
+            f'{held:.0f}',
+            f'{held_all:.0f}',
+        ])
+    print_table([
+        'containers', 'json', 'Con', 'find_focused', 'descendents',
+        'KB', 'KB all',
+    ], rows)
+
+
+def bench_queries(sizes: list[int], repeat: int) -> None:
+    print('Repeated queries on one tree, median us per call')
+    rows = []
+    for size in sizes:
+        tree = build(json.dumps(synthetic_tree(size)))
+        ids = [c.id for c in tree.descendents()]
+        windows = [c.window for c in tree.descendents() if c.window]
+        queries = {
+            'find_by_id': lambda: tree.find_by_id(ids[-1]),
+            'find_by_window': lambda: tree.find_by_window(windows[-1]),
+            'find_classed': lambda: tree.find_classed('^Emacs$'),
+            'find_named': lambda: tree.find_named('^mpv'),
+            'find_marked': lambda: tree.find_marked(),
+            'workspaces': lambda: tree.workspaces(),
+        }
+        row: list[Any] = [len(ids)]
+        for query in queries.values():
+            median, _ = measure(lambda: [query() for _ in range(100)], repeat)
+            row.append(f'{median * 10:.1f}')
+        rows.append(row)
+    print_table(['containers'] + list(queries), rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    bench_con(args.sizes, args.repeat)
+    bench_queries(args.sizes, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
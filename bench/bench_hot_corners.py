@@ -0,0 +1,153 @@
+#! /usr/bin/env python3
+"""Replay of XRecord replies through the hot_corners parser.
+
+Packs button events at the edges of a 1920x1080 screen into record
+payloads of 1 to 64 events, like the replies of clicks in a burst, and
+measures the events per second of a ctypes struct per event, of
+iter_button_events() and of the whole HotCornersApp.event_callback(),
+and the classification of points by get_area() on 1 to 64 monitors.
+
+    python bench/bench_hot_corners.py
+    python bench/bench_hot_corners.py --events 200000 --bursts 1 16
+"""
+from typing import Any, Callable
+import os
+import sys
+import argparse
+import ctypes
+import random
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import hot_corners  # noqa: E402
+from bench_ipc import print_table  # noqa: E402
+
+WIDTH = 1920
+HEIGHT = 1080
+# left, right and top edges and the middle of the screen
+POINTS = [(0, 500), (WIDTH - 1, 500), (960, 0), (960, 540)]
+
+
+def record_payload(count: int, offset: int = 0) -> bytes:
+    """Button presses and releases of the left and right buttons."""
+    events = []
+    for i in range(offset, offset + count):
+        x, y = POINTS[i % len(POINTS)]
+        response_type = hot_corners.XCB_BUTTON_RELEASE if i % 2 \
+            else hot_corners.XCB_BUTTON_PRESS
+        button = 3 if i % 4 < 2 else 1
+        events.append(hot_corners.BUTTON_EVENT.pack(
+            response_type, button, i & 0xffff, i, 1, 1, 0, x, y, x, y, 0, 1))
+    return b''.join(events)
+
+
+def replies(events: int, burst: int) -> list[Any]:
+    """The payloads as ctypes arrays, the way poll() hands them over."""
+    result = []
+    for offset in range(0, events, burst):
+        payload = record_payload(burst, offset)
+        result.append((ctypes.c_ubyte * len(payload)).from_buffer_copy(
+            payload))
+    return result
+
+
+def parse_ctypes(data: Any) -> int:
+    clicks = 0
+    size = ctypes.sizeof(hot_corners.xcb_button_event_t)
+    for offset in range(0, len(data) - size + 1, size):
+        event = hot_corners.xcb_button_event_t.from_buffer(data, offset)
+        if event.response_type == hot_corners.XCB_BUTTON_RELEASE:
+            clicks += 1
+    return clicks
+
+
+def parse_struct(data: Any) -> int:
+    clicks = 0
+    for response_type, _, _, _ in hot_corners.iter_button_events(data):
+        if response_type == hot_corners.XCB_BUTTON_RELEASE:
+            clicks += 1
+    return clicks
+
+
+class ReplayApp(hot_corners.HotCornersApp):
+    """Classifies the clicks without X and without running commands."""
+
+    def __init__(self, monitors: int = 1) -> None:
+        self.screen_width = WIDTH
+        self.screen_height = HEIGHT
+        self.zones = hot_corners.ZoneIndex(monitor_grid(monitors))
+        self.clicks = 0
+
+    def handle_lbm(self, x: int, y: int) -> None:
+        self.clicks += self.get_area(x, y) is not None
+
+    def handle_rbm(self, x: int, y: int) -> None:
+        self.clicks += self.get_area(x, y) is not None
+
+
+def monitor_grid(count: int) -> list[tuple[int, int, int, int]]:
+    """Monitors of the screen size in rows of four."""
+    return [
+        ((i % 4) * WIDTH, (i // 4) * HEIGHT, WIDTH, HEIGHT)
+        for i in range(count)
+    ]
+
+
+def bench_zones(monitors: list[int], points: int) -> None:
+    print(f'get_area() of {points} points, ns per point')
+    rows = []
+    for count in monitors:
+        app = ReplayApp(count)
+        rects = monitor_grid(count)
+        right = max(r[0] + r[2] for r in rects)
+        bottom = max(r[1] + r[3] for r in rects)
+        xy = [(random.randrange(right), random.randrange(bottom))
+              for _ in range(points)]
+        start = time.perf_counter()
+        for x, y in xy:
+            app.get_area(x, y)
+        elapsed = time.perf_counter() - start
+        rows.append([count, f'{elapsed / points * 1e9:.0f}'])
+    print_table(['monitors', 'ns/point'], rows)
+
+
+def rate(fn: Callable[[Any], Any], data: list[Any], events: int) -> float:
+    start = time.perf_counter()
+    for reply in data:
+        fn(reply)
+    return events / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--bursts', type=int, nargs='+',
+                        default=[1, 8, 64])
+    parser.add_argument('--monitors', type=int, nargs='+',
+                        default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    print(f'Replay of {args.events} button events, events per second')
+    app = ReplayApp()
+    rows = []
+    for burst in args.bursts:
+        data = replies(args.events, burst)
+        events = len(data) * burst
+        rows.append([
+            burst,
+            f'{rate(parse_ctypes, data, events):.0f}',
+            f'{rate(parse_struct, data, events):.0f}',
+            f'{rate(app.event_callback, data, events):.0f}',
+        ])
+    print_table(
+        ['events/reply', 'ctypes struct', 'iter_button_events',
+         'event_callback'],
+        rows,
+    )
+    bench_zones(args.monitors, args.events)
+
+
+if __name__ == '__main__':
+    main()
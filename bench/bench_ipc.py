@@ -0,0 +1,404 @@
+#! /usr/bin/env python3
+"""IPC benchmarks against the fake sway/i3 server.
+
+Measures the tree fetch and parse throughput of sway_ipc and i3ipc, the
+IPC cost of the i3 daemon commands built on i3patch/commands.py, the
+wall time of an srws restore, the event delivery rate and the pipelined
+requests and event streams of the asyncio clients, for trees from 10 to
+5,000 containers.
+
+    python bench/bench_ipc.py
+    python bench/bench_ipc.py --sizes 100 2000 --apps 12 --startup-ms 300
+"""
+from typing import Any, Callable
+import os
+import sys
+import argparse
+import asyncio
+import contextlib
+import json
+import statistics
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path[:0] = [
+    os.path.join(REPO_DIR, 'sway_restore_workspace'),
+    os.path.join(REPO_DIR, 'i3patch'),
+]
+
+import sway_ipc  # noqa: E402
+import i3ipc  # noqa: E402
+import commands  # noqa: E402
+import srws  # noqa: E402
+from fake_ipc import (  # noqa: E402
+    FakeIPCServer,
+    synthetic_tree,
+    count_containers,
+    find_workspaces,
+    make_window,
+    window_events,
+)
+
+
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'bench-ipc.sock')
+# relative startup times of the synthetic apps
+APP_STARTUP = {
+    'Alacritty': 0.3,
+    'firefox': 2.0,
+    'foot': 0.2,
+    'Emacs': 1.5,
+    'mpv': 0.5,
+}
+
+
+def measure(fn: Callable[[], Any], repeat: int) -> tuple[float, float]:
+    """Returns the median and the worst time of the calls in ms."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), max(times)
+
+
+def print_table(header: list[str], rows: list[list[Any]]) -> None:
+    cells = [header] + [[str(c) for c in row] for row in rows]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(header))]
+    for i, row in enumerate(cells):
+        print('  '.join(c.rjust(w) for c, w in zip(row, widths)))
+        if i == 0:
+            print('  '.join('-' * w for w in widths))
+    print()
+
+
+def bench_tree_parse(
+    server: FakeIPCServer,
+    sizes: list[int],
+    repeat: int,
+) -> None:
+    print('Tree fetch and parse, median ms')
+    sock = sway_ipc.get_socket()
+    i3 = i3ipc.Connection(SOCKET_PATH)
+    rows = []
+    for size in sizes:
+        tree = synthetic_tree(size)
+        server.set_tree(tree)
+        size_kb = len(server.tree_payload) / 1024
+        fetch, _ = measure(lambda: sway_ipc.get_tree(sock), repeat)
+        index, _ = measure(lambda: sway_ipc.TreeIndex(tree), repeat)
+        con, _ = measure(lambda: i3.get_tree(), repeat)
+        rows.append([
+            count_containers(tree),
+            f'{size_kb:.0f}',
+            f'{fetch:.2f}',
+            f'{size_kb / 1024 / fetch * 1000:.1f}',
+            f'{index:.2f}',
+            f'{con:.2f}',
+        ])
+    sock.close()
+    print_table(
+        ['containers', 'KB', 'get_tree', 'MB/s', 'TreeIndex', 'i3ipc.Con'],
+        rows,
+    )
+
+
+def daemon_commands(
+    i3: i3ipc.Connection,
+    cache: i3ipc.TreeCache,
+) -> dict[str, Callable[[], Any]]:
+    """The daemon commands on the helpers of i3patch/commands.py, the
+    daemon itself can't be imported without a running i3 and Gdk. The
+    tree has a zoomed window, see bench_daemon().
+    """
+    state = commands.State()
+    state.refresh(cache.get())
+    zoomed_cons: dict[int, int] = {}
+
+    def smart_fullscreen(tree: Any) -> None:
+        cmd = commands.smart_fullscreen_command(
+            tree.find_focused(), 'zoom', 'zoomed')
+        if cmd:
+            i3.command(cmd)
+
+    def create_workspace() -> None:
+        i3.command('workspace %d' % state.reserve_num())
+
+    def scratch_to_from() -> None:
+        i3.command('scratchpad show floating disable'
+                   if state.scratch_leaves > 0 else 'move scratchpad')
+
+    def relabel_workspaces() -> None:
+        tree = cache.get()
+        zoomed_cons.update(commands.zoomed_workspaces(tree))
+        cmd = commands.relabel_command(commands.workspace_renames(
+            cache, zoomed_cons, [w.id for w in tree.workspaces()]))
+        if cmd:
+            i3.command(cmd)
+
+    def zoom_event() -> None:
+        # the zoomed window is zoomed and restored in turns
+        focused = cache.get().find_focused()
+        workspace_id = None if focused.id in zoomed_cons \
+            else focused.workspace().id
+        changed = commands.update_zoomed(
+            zoomed_cons, focused.id, workspace_id)
+        cmd = commands.relabel_command(
+            commands.workspace_renames(cache, zoomed_cons, changed))
+        if cmd:
+            i3.command(cmd)
+
+    return {
+        'smart_fullscreen (get_tree)': lambda: smart_fullscreen(
+            i3.get_tree()),
+        'smart_fullscreen (mirror)': lambda: smart_fullscreen(cache.get()),
+        'create_workspace': create_workspace,
+        'scratch_to_from': scratch_to_from,
+        'State.refresh': lambda: state.refresh(cache.get()),
+        'relabel (full scan)': relabel_workspaces,
+        'relabel (zoom event)': zoom_event,
+    }
+
+
+def zoomed_tree(size: int) -> dict[str, Any]:
+    tree = synthetic_tree(size)
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if node['focused']:
+            node['zoomed'] = True
+        stack.extend(node['nodes'])
+    return tree
+
+
+def bench_daemon(server: FakeIPCServer, sizes: list[int], repeat: int) -> None:
+    print('Daemon command latency, median / worst ms')
+    i3 = i3ipc.Connection(SOCKET_PATH)
+    cache = i3ipc.TreeCache(i3)
+    rows = []
+    for size in sizes:
+        server.set_tree(zoomed_tree(size))
+        cache.invalidate()
+        row: list[Any] = [size]
+        for fn in daemon_commands(i3, cache).values():
+            median, worst = measure(fn, repeat)
+            row.append(f'{median:.2f} / {worst:.2f}')
+        rows.append(row)
+    print_table(['containers'] + list(daemon_commands(i3, cache)), rows)
+
+
+class BenchManager(srws.WorkspaceManager):
+    """Instead of spawning the apps asks the fake server to send the
+    window::new events after the startup time of each app.
+    """
+
+    def __init__(self, server: FakeIPCServer, startup: float) -> None:
+        super().__init__()
+        self.server = server
+        self.startup = startup
+        self.next_id = 100000
+        self.app_ids = {v: k for k, v in self.EXECUTABLES.items()}
+
+    def run_detached(self, cmd: str) -> Any:
+        self.next_id += 1
+        app_id = cmd.split()[0]
+        app_id = self.app_ids.get(app_id, app_id)
+        container = make_window(self.next_id, app_id, pid=self.next_id)
+        delay = self.startup * APP_STARTUP.get(app_id, 1)
+        self.server.emit_later(
+            delay, 'window', {'change': 'new', 'container': container})
+        return SimpleNamespace(pid=self.next_id)
+
+
+def bench_restore(server: FakeIPCServer, apps: int, startup: float) -> None:
+    print(f'srws restore of ~{apps} apps, startup {startup * 1000:.0f} ms')
+    tree = synthetic_tree(apps * 2, workspaces=1)
+    server.set_tree(tree)
+    workspace = find_workspaces(tree)[0]
+    apps_index = sway_ipc.TreeIndex(workspace).apps
+    app_count = sum(len(nodes) for nodes in apps_index.values())
+    with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                     delete=False) as f:
+        json.dump(workspace, f)
+    rows = []
+    devnull = open(os.devnull, 'w')
+    for concurrent in (False, True):
+        server.reset_counters()
+        manager = BenchManager(server, startup)
+        stdout, sys.stdout = sys.stdout, devnull
+        start = time.perf_counter()
+        try:
+            manager.load_workspace(f.name, concurrent)
+        finally:
+            sys.stdout = stdout
+        wall = time.perf_counter() - start
+        rows.append([
+            'concurrent' if concurrent else 'sequential',
+            app_count,
+            f'{wall:.2f}',
+            server.messages,
+            server.commands,
+        ])
+    devnull.close()
+    os.remove(f.name)
+    print_table(['mode', 'apps', 'wall s', 'messages', 'commands'], rows)
+
+
+def bench_events(server: FakeIPCServer, count: int, rate: float) -> None:
+    print(f'Event delivery of {count} window events to i3ipc.Connection')
+    tree = synthetic_tree(500)
+    server.set_tree(tree)
+    events = window_events(tree, count)
+    # the handlers run inline or on the pool, the last run subscribes a
+    # change which is never sent, so every event is dropped unparsed
+    runs = [
+        ('inline', 'window', 0),
+        ('pool', 'window', 2),
+        ('unsubscribed change', 'window::new', 0),
+    ]
+    rows = []
+    for mode, event, workers in runs:
+        received = []
+
+        def handler(i3: i3ipc.Connection, e: Any) -> None:
+            received.append(time.perf_counter())
+
+        i3 = i3ipc.Connection(SOCKET_PATH, workers=workers)
+        i3.on(event, handler)
+        thread = threading.Thread(target=i3.main)
+        thread.daemon = True
+        thread.start()
+        while not server.subscribers:
+            time.sleep(0.01)
+        start = time.perf_counter()
+        sent = server.replay(events, rate or None)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            stats = i3.event_stats()
+            if stats['received'] == count and not stats.get('pending'):
+                break
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        stats = i3.event_stats()
+        i3.main_quit()
+        thread.join(5)
+        while server.subscribers:
+            time.sleep(0.01)
+        rows.append([
+            mode,
+            f'{count / sent:.0f}',
+            len(received),
+            stats['skipped'],
+            stats.get('peak_pending', '-'),
+            f'{stats["received"] / elapsed:.0f}',
+        ])
+    print_table(['mode', 'sent/s', 'handled', 'skipped', 'peak queue',
+                 'processed/s'], rows)
+
+
+async def async_client(
+    conn: Any,
+    server: FakeIPCServer,
+    requests: int,
+    events: list[tuple[str, dict[str, Any]]],
+) -> list[str]:
+    """Requests one by one and all in flight, then the event stream."""
+    await conn.connect()
+    start = time.perf_counter()
+    for _ in range(requests):
+        await conn.command('nop')
+    sequential = requests / (time.perf_counter() - start)
+    start = time.perf_counter()
+    await asyncio.gather(*(conn.command('nop') for _ in range(requests)))
+    pipelined = requests / (time.perf_counter() - start)
+
+    async def consume() -> int:
+        received = 0
+        async with contextlib.aclosing(conn.subscribe(['window'])) as stream:
+            async for event in stream:
+                assert event.type == 'window' and event.change is not None
+                received += 1
+                if received == len(events):
+                    break
+        return received
+
+    task = asyncio.ensure_future(consume())
+    while not server.subscribers:
+        await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    await asyncio.get_running_loop().run_in_executor(
+        None, server.replay, events)
+    received = await asyncio.wait_for(task, 30)
+    delivered = received / (time.perf_counter() - start)
+    await conn.close()
+    while server.subscribers:
+        await asyncio.sleep(0.01)
+    return [f'{sequential:.0f}', f'{pipelined:.0f}', f'{delivered:.0f}']
+
+
+def bench_async(server: FakeIPCServer, requests: int, count: int) -> None:
+    print(f'asyncio clients, {requests} commands and {count} window events, '
+          'per second')
+    tree = synthetic_tree(500)
+    server.set_tree(tree)
+    events = window_events(tree, count)
+    sock = sway_ipc.get_socket()
+    i3 = i3ipc.Connection(SOCKET_PATH)
+    blocking = {
+        'sway_ipc': lambda: sway_ipc.command(sock, 'nop'),
+        'i3ipc': lambda: i3.command('nop'),
+    }
+    clients = {
+        'sway_ipc': lambda: sway_ipc.AsyncConnection(SOCKET_PATH, 64),
+        'i3ipc': lambda: i3ipc.AsyncConnection(SOCKET_PATH, 64),
+    }
+    rows = []
+    for name, client in clients.items():
+        start = time.perf_counter()
+        for _ in range(requests):
+            blocking[name]()
+        rate = requests / (time.perf_counter() - start)
+        rows.append([name, f'{rate:.0f}'] + asyncio.run(
+            async_client(client(), server, requests, events)))
+    sock.close()
+    print_table(['client', 'blocking', 'async', 'pipelined', 'events'],
+                rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000, 5000])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--apps', type=int, default=12)
+    parser.add_argument('--startup-ms', type=float, default=200)
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--event-rate', type=float, default=0,
+                        help='events per second, as fast as possible if 0')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--only', choices=[
+        'parse', 'daemon', 'restore', 'events', 'async'])
+    args = parser.parse_args()
+
+    os.environ['SWAYSOCK'] = SOCKET_PATH
+    os.environ['I3SOCK'] = SOCKET_PATH
+    server = FakeIPCServer(SOCKET_PATH, synthetic_tree(10)).start()
+    try:
+        if args.only in (None, 'parse'):
+            bench_tree_parse(server, args.sizes, args.repeat)
+        if args.only in (None, 'daemon'):
+            bench_daemon(server, args.sizes, args.repeat)
+        if args.only in (None, 'restore'):
+            bench_restore(server, args.apps, args.startup_ms / 1000)
+        if args.only in (None, 'events'):
+            bench_events(server, args.events, args.event_rate)
+        if args.only in (None, 'async'):
+            bench_async(server, args.requests, args.events)
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,417 @@
+#! /usr/bin/env python3
+"""A fake sway/i3 IPC server for the benchmarks.
+
+It speaks the i3-ipc framing on a Unix socket, serves a recorded or a
+synthetic tree, answers commands with a success per command and sends
+events to the subscribers, either one by one or replayed at a rate.
+"""
+from typing import Any, Callable
+import os
+import sys
+import argparse
+import json
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+
+MAGIC = b'i3-ipc'
+HEADER = '=6sII'
+HEADER_SIZE = struct.calcsize(HEADER)
+
+COMMAND = 0
+GET_WORKSPACES = 1
+SUBSCRIBE = 2
+GET_OUTPUTS = 3
+GET_TREE = 4
+GET_MARKS = 5
+GET_VERSION = 7
+
+EVENT_TYPES = {
+    'workspace': 0,
+    'output': 1,
+    'mode': 2,
+    'window': 3,
+    'barconfig_update': 4,
+    'binding': 5,
+    'shutdown': 6,
+    'tick': 7,
+}
+
+
+def pack(msg_type: int, payload: bytes) -> bytes:
+    return struct.pack(HEADER, MAGIC, len(payload), msg_type) + payload
+
+
+def rect(x: int, y: int, width: int, height: int) -> dict[str, int]:
+    return {'x': x, 'y': y, 'width': width, 'height': height}
+
+
+def make_con(
+    con_id: int,
+    con_type: str,
+    name: str | None,
+    nodes: list[dict[str, Any]],
+    **props: Any,
+) -> dict[str, Any]:
+    con = {
+        'id': con_id,
+        'type': con_type,
+        'name': name,
+        'border': 'normal',
+        'current_border_width': 2,
+        'layout': 'splith',
+        'orientation': 'horizontal',
+        'percent': None,
+        'rect': rect(0, 0, 1920, 1080),
+        'window_rect': rect(0, 0, 0, 0),
+        'deco_rect': rect(0, 0, 0, 0),
+        'geometry': rect(0, 0, 0, 0),
+        'window': None,
+        'urgent': False,
+        'marks': [],
+        'focused': False,
+        'focus': [n['id'] for n in nodes],
+        'fullscreen_mode': 0,
+        'sticky': False,
+        'floating': 'auto_off',
+        'scratchpad_state': 'none',
+        'zoomed': False,
+        'nodes': nodes,
+        'floating_nodes': [],
+    }
+    con.update(props)
+    return con
+
+
+def make_window(con_id: int, app_id: str, pid: int = 0) -> dict[str, Any]:
+    return make_con(
+        con_id, 'con', f'{app_id} {con_id}', [],
+        layout='none',
+        orientation='none',
+        percent=0.5,
+        window=10000 + con_id,
+        app_id=app_id,
+        pid=pid,
+        window_properties={
+            'class': app_id,
+            'instance': app_id.lower(),
+            'title': f'{app_id} {con_id}',
+        },
+        deco_rect=rect(0, 0, 960, 22),
+    )
+
+
+APP_IDS = ['Alacritty', 'firefox', 'foot', 'Emacs', 'mpv']
+
+
+def synthetic_tree(containers: int, workspaces: int = 10) -> dict[str, Any]:
+    """Builds an i3/sway-like tree with about the given number of
+    containers: workspaces of nested splits with windows as the leaves,
+    a scratchpad and the last window focused.
+    """
+    next_id = iter(range(1, 10 * containers + 100))
+    workspaces = max(1, min(workspaces, containers // 10))
+    per_workspace = max(1, (containers - workspaces - 4) // workspaces)
+    last_window: dict[str, Any] | None = None
+
+    def split(count: int, depth: int) -> list[dict[str, Any]]:
+        nonlocal last_window
+        if count <= 3 or depth > 4:
+            windows = []
+            for _ in range(max(count, 1)):
+                con_id = next(next_id)
+                window = make_window(con_id, APP_IDS[con_id % len(APP_IDS)])
+                windows.append(window)
+                last_window = window
+            return windows
+        half = count // 2
+        layout = 'splitv' if depth % 2 else 'splith'
+        orientation = 'vertical' if depth % 2 else 'horizontal'
+        return [
+            make_con(next(next_id), 'con', None, split(half - 1, depth + 1),
+                     layout=layout, orientation=orientation, percent=0.5),
+            make_con(next(next_id), 'con', None,
+                     split(count - half - 1, depth + 1),
+                     layout=layout, orientation=orientation, percent=0.5),
+        ]
+
+    workspace_cons = []
+    for num in range(1, workspaces + 1):
+        workspace_cons.append(make_con(
+            next(next_id), 'workspace', f'{num}', split(per_workspace, 0),
+            num=num, output='HDMI-A-1'))
+    if last_window is not None:
+        last_window['focused'] = True
+    scratch = make_con(next(next_id), 'workspace', '__i3_scratch', [],
+                       num=-1)
+    outputs = [
+        make_con(next(next_id), 'output', '__i3', [
+            make_con(next(next_id), 'con', 'content', [scratch]),
+        ]),
+        make_con(next(next_id), 'output', 'HDMI-A-1', [
+            make_con(next(next_id), 'con', 'content', workspace_cons),
+        ]),
+    ]
+    root = make_con(0, 'root', 'root', outputs)
+    focus_path(root)
+    return root
+
+
+def focus_path(node: dict[str, Any]) -> bool:
+    """Moves the children on the path to the focused con to the front of
+    the focus lists, the way i3 orders them.
+    """
+    for child in node['nodes'] + node['floating_nodes']:
+        if child['focused'] or focus_path(child):
+            node['focus'].remove(child['id'])
+            node['focus'].insert(0, child['id'])
+            return True
+    return False
+
+
+def count_containers(tree: dict[str, Any]) -> int:
+    return 1 + sum(
+        count_containers(n) for n in tree['nodes'] + tree['floating_nodes'])
+
+
+def find_workspaces(tree: dict[str, Any]) -> list[dict[str, Any]]:
+    if tree['type'] == 'workspace':
+        return [] if tree['name'].startswith('__') else [tree]
+    workspaces = []
+    for n in tree['nodes']:
+        workspaces.extend(find_workspaces(n))
+    return workspaces
+
+
+def count_commands(payload: str) -> int:
+    count = 1
+    quoted = False
+    for char in payload:
+        if char == '"':
+            quoted = not quoted
+        elif char in ';,' and not quoted:
+            count += 1
+    return count
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    server: '_UnixServer'
+
+    def recv_exactly(self, size: int) -> bytes | None:
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+    def handle(self) -> None:
+        fake = self.server.fake
+        with fake.lock:
+            fake.clients.add(self.request)
+        while True:
+            header = self.recv_exactly(HEADER_SIZE)
+            if header is None:
+                break
+            _, length, msg_type = struct.unpack(HEADER, header)
+            payload = self.recv_exactly(length)
+            if payload is None:
+                break
+            reply = fake.reply(self.request, msg_type, payload.decode())
+            with fake.lock:
+                self.request.sendall(pack(msg_type, reply))
+        fake.unsubscribe(self.request)
+        with fake.lock:
+            fake.clients.discard(self.request)
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    fake: 'FakeIPCServer'
+
+
+class FakeIPCServer:
+    def __init__(self, path: str, tree: dict[str, Any]) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.subscribers: dict[socket.socket, set[str]] = {}
+        self.clients: set[socket.socket] = set()
+        self.messages = 0
+        self.commands = 0
+        self.on_command: Callable[[str], None] | None = None
+        self.set_tree(tree)
+        self.server: _UnixServer | None = None
+
+    def set_tree(self, tree: dict[str, Any]) -> None:
+        self.tree = tree
+        self.tree_payload = json.dumps(tree).encode()
+        workspaces = [
+            {
+                'id': w['id'],
+                'num': w.get('num', -1),
+                'name': w['name'],
+                'rect': w['rect'],
+                'focused': w['focused'],
+                'visible': True,
+                'urgent': False,
+                'output': w.get('output', ''),
+            }
+            for w in find_workspaces(tree)
+        ]
+        self.workspaces_payload = json.dumps(workspaces).encode()
+
+    def start(self) -> 'FakeIPCServer':
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = _UnixServer(self.path, _Handler)
+        self.server.fake = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        # like i3 on exit, every client sees EOF
+        with self.lock:
+            for sock in self.clients:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            for sock in self.subscribers:
+                sock.close()
+            self.subscribers = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def reset_counters(self) -> None:
+        self.messages = 0
+        self.commands = 0
+
+    def reply(self, sock: socket.socket, msg_type: int, payload: str) -> bytes:
+        self.messages += 1
+        if msg_type == COMMAND:
+            count = count_commands(payload)
+            self.commands += count
+            if self.on_command is not None:
+                self.on_command(payload)
+            return json.dumps([{'success': True}] * count).encode()
+        if msg_type == GET_TREE:
+            return self.tree_payload
+        if msg_type == GET_WORKSPACES:
+            return self.workspaces_payload
+        if msg_type == SUBSCRIBE:
+            with self.lock:
+                self.subscribers[sock] = set(json.loads(payload))
+            return b'{"success": true}'
+        if msg_type == GET_OUTPUTS:
+            return b'[{"name": "HDMI-A-1", "active": true, "rect": ' \
+                + json.dumps(self.tree['rect']).encode() + b'}]'
+        if msg_type == GET_MARKS:
+            return b'[]'
+        if msg_type == GET_VERSION:
+            return b'{"major": 4, "minor": 24, "patch": 0, ' \
+                b'"human_readable": "fake", "loaded_config_file_name": ""}'
+        return b'{"success": false}'
+
+    def unsubscribe(self, sock: socket.socket) -> None:
+        with self.lock:
+            self.subscribers.pop(sock, None)
+
+    def emit(self, event: str, payload: dict[str, Any]) -> None:
+        message = pack(
+            0x80000000 | EVENT_TYPES[event], json.dumps(payload).encode())
+        with self.lock:
+            for sock, events in list(self.subscribers.items()):
+                if event in events:
+                    try:
+                        sock.sendall(message)
+                    except OSError:
+                        self.subscribers.pop(sock, None)
+
+    def emit_later(
+        self,
+        delay: float,
+        event: str,
+        payload: dict[str, Any],
+    ) -> None:
+        timer = threading.Timer(delay, self.emit, (event, payload))
+        timer.daemon = True
+        timer.start()
+
+    def replay(
+        self,
+        events: list[tuple[str, dict[str, Any]]],
+        rate: float | None = None,
+    ) -> float:
+        """Sends the events at the given rate per second or as fast as
+        possible, returns the time it took.
+        """
+        start = time.perf_counter()
+        for i, (event, payload) in enumerate(events):
+            if rate:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self.emit(event, payload)
+        return time.perf_counter() - start
+
+
+def window_events(
+    tree: dict[str, Any],
+    count: int,
+) -> list[tuple[str, dict[str, Any]]]:
+    """A stream of focus and title events over the windows of the tree."""
+    windows = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if node['window'] is not None:
+            windows.append(node)
+        stack.extend(node['nodes'])
+    events = []
+    for i in range(count):
+        window = windows[i % len(windows)]
+        change = 'focus' if i % 2 else 'title'
+        events.append(('window', {'change': change, 'container': window}))
+    return events
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--socket', default='/tmp/fake-ipc.sock')
+    parser.add_argument('--tree', help='a recorded GET_TREE reply')
+    parser.add_argument('--containers', type=int, default=500)
+    parser.add_argument('--event-rate', type=float, default=0,
+                        help='window events per second to replay')
+    args = parser.parse_args()
+
+    if args.tree:
+        with open(args.tree) as f:
+            tree = json.load(f)
+    else:
+        tree = synthetic_tree(args.containers)
+    server = FakeIPCServer(args.socket, tree).start()
+    print(f'Serving {count_containers(tree)} containers on {args.socket}')
+    try:
+        while True:
+            if args.event_rate:
+                server.replay(window_events(tree, int(args.event_rate)),
+                              args.event_rate)
+            else:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
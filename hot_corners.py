@@ -1,21 +1,34 @@
 #!/usr/bin/env python3
 
 import signal
+import struct
+from bisect import bisect_right
 import subprocess
+import threading
+import time
 import ctypes
 import ctypes.util
 
-# commands to run on right mouse click
+import wm_ipc
+
+# commands to run on right mouse click, a list runs a process,
+# "ipc:<command>" sends an i3/sway command over the IPC socket
 LMB_TOP_CMD = []
 RMB_TOP_CMD = ['sh', "./.config/i3/scripts/smart_fullscreen.sh"]
-RMB_RIGHT_CMD =  ['i3-msg', "workspace", 'next']
-RMB_LEFT_CMD =  ['i3-msg', "workspace", 'prev']
+RMB_RIGHT_CMD = 'ipc:workspace next'
+RMB_LEFT_CMD = 'ipc:workspace prev'
+IPC_PREFIX = 'ipc:'
 
 # width (height) of clickable area
 TOP_THRESHOLD = 0
 RIGHT_THRESHOLD = 2
 LEFT_THRESHOLD = 2
 
+# clicks on an area within the delay (s) are merged into one command,
+# ipc and i3-msg commands are chained once per click up to the max repeat
+DEBOUNCE_DELAY = 0.12
+MAX_REPEAT = 10
+
 xcb_button_t = ctypes.c_ubyte
 xcb_timestamp_t = ctypes.c_uint
 xcb_window_t  = ctypes.c_uint
@@ -192,27 +205,200 @@ class xcb_record_enable_context_reply_t(ctypes.Structure):
 
 xcb_record_client_spec_t = ctypes.c_uint
 
+
+class xcb_generic_event_t(ctypes.Structure):
+    _fields_ = [
+        ('response_type', ctypes.c_ubyte),
+        ('pad0', ctypes.c_ubyte),
+        ('sequence', ctypes.c_ushort),
+        ('pad', ctypes.c_uint*7),
+        ('full_sequence', ctypes.c_uint),
+    ]
+
+
+class xcb_randr_get_screen_resources_current_reply_t(ctypes.Structure):
+    _fields_ = [
+        ('response_type', ctypes.c_ubyte),
+        ('pad0', ctypes.c_ubyte),
+        ('sequence', ctypes.c_ushort),
+        ('length', ctypes.c_uint),
+        ('timestamp', ctypes.c_uint),
+        ('config_timestamp', ctypes.c_uint),
+        ('num_crtcs', ctypes.c_ushort),
+        ('num_outputs', ctypes.c_ushort),
+        ('num_modes', ctypes.c_ushort),
+        ('names_len', ctypes.c_ushort),
+        ('pad1', ctypes.c_ubyte*8),
+    ]
+
+
+class xcb_randr_get_crtc_info_reply_t(ctypes.Structure):
+    _fields_ = [
+        ('response_type', ctypes.c_ubyte),
+        ('status', ctypes.c_ubyte),
+        ('sequence', ctypes.c_ushort),
+        ('length', ctypes.c_uint),
+        ('timestamp', ctypes.c_uint),
+        ('x', ctypes.c_short),
+        ('y', ctypes.c_short),
+        ('width', ctypes.c_ushort),
+        ('height', ctypes.c_ushort),
+        ('mode', ctypes.c_uint),
+        ('rotation', ctypes.c_ushort),
+        ('rotations', ctypes.c_ushort),
+        ('num_outputs', ctypes.c_ushort),
+        ('num_possible_outputs', ctypes.c_ushort),
+    ]
+
+
 XCB_RECORD_CS_ALL_CLIENTS = 3
 XCB_BUTTON_PRESS = 4
 XCB_BUTTON_RELEASE = 5
 XRecordFromServer = 0
 
+XCB_RANDR_SCREEN_CHANGE_NOTIFY = 0
+XCB_RANDR_NOTIFY = 1
+XCB_RANDR_NOTIFY_MASK_SCREEN_CHANGE = 1
+XCB_RANDR_NOTIFY_MASK_CRTC_CHANGE = 2
+
+# xcb_button_event_t, the payload of a record reply is a run of them
+BUTTON_EVENT = struct.Struct('=BBHIIIIhhhhHBx')
+
+
+def iter_button_events(data):
+    """
+    Yields (response_type, button, root_x, root_y) of every event in the
+    payload of a record reply, unpacked in place from a buffer.
+    """
+    data = memoryview(data)
+    size = len(data) - len(data) % BUTTON_EVENT.size
+    for event in BUTTON_EVENT.iter_unpack(data[:size]):
+        yield event[0], event[1], event[7], event[8]
+
+
+class ZoneIndex(object):
+    """
+    Finds the monitor under a point. The left and right edges of the
+    monitors cut the screen into vertical slabs, every slab holds the
+    monitors which span it sorted by the top edge, so a point takes a
+    bisect on x and a bisect on y.
+    """
+    def __init__(self, rects):
+        self.xs = sorted({x for r in rects for x in (r[0], r[0] + r[2])})
+        self.slabs = []
+        for left, right in zip(self.xs, self.xs[1:]):
+            column = sorted(
+                (r[1], r[1] + r[3], r) for r in rects
+                if r[0] <= left and r[0] + r[2] >= right
+            )
+            self.slabs.append(([c[0] for c in column], column))
+
+    def find(self, x, y):
+        i = bisect_right(self.xs, x) - 1
+        if i < 0 or i >= len(self.slabs):
+            return None
+        tops, column = self.slabs[i]
+        j = bisect_right(tops, y) - 1
+        if j < 0:
+            return None
+        top, bottom, rect = column[j]
+        return rect if y < bottom else None
+
+
+class ActionExecutor(threading.Thread):
+    """
+    Runs the commands of the clicks off the record loop. The clicks of an
+    area are held until no click came for the debounce delay and then run
+    as one command: an ipc or i3-msg command is chained once per click,
+    e.g. ten clicks on the right edge advance ten workspaces, any other
+    command runs once. The clicks which come while a command runs merge into the
+    next one, the clicks over the max repeat are dropped.
+    """
+    def __init__(self, delay=DEBOUNCE_DELAY, max_repeat=MAX_REPEAT):
+        super().__init__(daemon=True)
+        self.delay = delay
+        self.max_repeat = max_repeat
+        self.dropped = 0
+        self.ipc = wm_ipc.IPCClient()
+        # area -> [cmd, clicks, deadline], at most one per area
+        self.pending = {}
+        self.cond = threading.Condition()
+
+    def submit(self, area, cmd):
+        with self.cond:
+            action = self.pending.get(area)
+            if action is None:
+                action = self.pending[area] = [cmd, 0, 0]
+            if action[1] >= self.max_repeat:
+                self.dropped += 1
+                return
+            action[1] += 1
+            action[2] = time.monotonic() + self.delay
+            self.cond.notify()
+
+    def next_action(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                timeout = None
+                for area, (cmd, clicks, deadline) in self.pending.items():
+                    if deadline <= now:
+                        del self.pending[area]
+                        return cmd, clicks
+                    if timeout is None or deadline - now < timeout:
+                        timeout = deadline - now
+                self.cond.wait(timeout)
+
+    @staticmethod
+    def merge(cmd, clicks):
+        if isinstance(cmd, str):
+            cmd = cmd[len(IPC_PREFIX):].strip()
+            return IPC_PREFIX + '; '.join([cmd] * clicks)
+        if cmd[0] == 'i3-msg':
+            return ['i3-msg', '; '.join([' '.join(cmd[1:])] * clicks)]
+        return cmd
+
+    def execute(self, cmd):
+        if isinstance(cmd, str):
+            if not all(self.ipc.command(cmd[len(IPC_PREFIX):])):
+                print('Failed: %s' % cmd)
+        else:
+            subprocess.call(cmd)
+
+    def run(self):
+        while True:
+            cmd, clicks = self.next_action()
+            try:
+                self.execute(self.merge(cmd, clicks))
+            except (OSError, ValueError) as e:
+                print('Cant run %s: %s' % (cmd, e))
+
 
 class HotCornersApp(object):
     def __init__(self):
         signal.signal(signal.SIGINT, self._exit)
+        self.executor = ActionExecutor()
+        self.executor.start()
         self._init_xcb_record()
         self._get_screen_data()
+        self._init_randr()
         self._init_record_handler()
         self.poll()
 
     def _exit(self, *args):
         self.xcb.xcb_disconnect(self.conn)
+        if getattr(self, 'randr_conn', None):
+            self.xcb.xcb_disconnect(self.randr_conn)
         exit()
 
     def get_area(self, x, y):
-        w = self.screen_width
-        h = self.screen_height
+        # the thresholds are tested against the monitor under the pointer
+        monitor = self.zones.find(x, y)
+        if monitor is None:
+            return None
+        x -= monitor[0]
+        y -= monitor[1]
+        w = monitor[2]
         if y <= TOP_THRESHOLD and x > LEFT_THRESHOLD \
            and x < w - RIGHT_THRESHOLD:
            return 'top'
@@ -222,34 +408,29 @@ class HotCornersApp(object):
            return 'left'
         return None
 
-    def handle_lbm(self, event):
-        area = self.get_area(event.root_x, event.root_y)
-        if RMB_TOP_CMD and area == 'top':
-            subprocess.call(LMB_TOP_CMD)
+    def handle_lbm(self, x, y):
+        area = self.get_area(x, y)
+        if LMB_TOP_CMD and area == 'top':
+            self.executor.submit('lmb_top', LMB_TOP_CMD)
 
-    def handle_rbm(self, event):
-        area = self.get_area(event.root_x, event.root_y)
+    def handle_rbm(self, x, y):
+        area = self.get_area(x, y)
         if RMB_TOP_CMD and area == 'top':
-            subprocess.call(RMB_TOP_CMD)
+            self.executor.submit('rmb_top', RMB_TOP_CMD)
         elif RMB_RIGHT_CMD and area == 'right':
-            subprocess.call(RMB_RIGHT_CMD)
+            self.executor.submit('rmb_right', RMB_RIGHT_CMD)
         elif RMB_LEFT_CMD and area == 'left':
-            subprocess.call(RMB_LEFT_CMD)
-
-    def event_callback(self, reply, data):
-        response = ctypes.cast(
-            data,
-            ctypes.POINTER(xcb_generic_reply_t)
-        ).contents
-        if response.response_type == XCB_BUTTON_RELEASE:
-            button_event = ctypes.cast(
-                data,
-                ctypes.POINTER(xcb_button_event_t)
-            ).contents
-            if response.pad0 == 1 and LMB_TOP_CMD:
-                self.handle_lbm(button_event)
-            elif response.pad0 == 3:
-                self.handle_rbm(button_event)
+            self.executor.submit('rmb_left', RMB_LEFT_CMD)
+
+    def event_callback(self, data):
+        # clicks in a burst come in one reply
+        for response_type, button, x, y in iter_button_events(data):
+            if response_type != XCB_BUTTON_RELEASE:
+                continue
+            if button == 1 and LMB_TOP_CMD:
+                self.handle_lbm(x, y)
+            elif button == 3:
+                self.handle_rbm(x, y)
 
     def poll(self):
         while True:
@@ -265,11 +446,21 @@ class HotCornersApp(object):
                 self._exit()
 
             if reply.contents.category == XRecordFromServer:
+                length = \
+                    self.xcb_record.xcb_record_enable_context_data_length(
+                        reply
+                    )
                 data = self.xcb_record.xcb_record_enable_context_data(
                     reply
                 )
-                self.event_callback(reply, data)
-                self.xcb_record.free(reply)
+                if length > 0:
+                    # a view of the reply, it's parsed before the free
+                    self.event_callback(
+                        (ctypes.c_ubyte * length).from_address(
+                            ctypes.addressof(data.contents)
+                        )
+                    )
+            self.xcb_record.free(reply)
 
     def _init_xcb_record(self):
         xcb_location = ctypes.util.find_library('xcb')
@@ -281,35 +472,170 @@ class HotCornersApp(object):
         self.xcb.xcb_request_check.restype = ctypes.POINTER(
             xcb_generic_error_t
         )
-        cookie = self.xcb.xcb_query_extension(
-            self.conn,
-            ctypes.c_ushort(6),
-            ctypes.c_char_p(b'RECORD')
-        )
         self.xcb.xcb_query_extension_reply.restype = ctypes.POINTER(
             xcb_query_extension_reply_t
         )
-        reply = self.xcb.xcb_query_extension_reply(
-            self.conn, cookie, None
-        )
-        present = reply.contents.present
-        self.xcb.free(reply)
+        present, _ = self._query_extension(self.conn, b'RECORD')
         if not present:
             print('No RECORD extension')
             self._exit()
         xcb_record_location = ctypes.util.find_library('xcb-record')
         self.xcb_record = ctypes.CDLL(xcb_record_location)
 
-    def _get_screen_data(self):
-        setup = self.xcb.xcb_get_setup(self.conn)
+    def _query_extension(self, conn, name):
+        cookie = self.xcb.xcb_query_extension(
+            conn,
+            ctypes.c_ushort(len(name)),
+            ctypes.c_char_p(name)
+        )
+        reply = self.xcb.xcb_query_extension_reply(
+            conn, cookie, None
+        )
+        if not reply:
+            return False, 0
+        present = reply.contents.present
+        first_event = reply.contents.first_event
+        self.xcb.free(reply)
+        return present, first_event
+
+    def _root_screen(self, conn):
+        self.xcb.xcb_get_setup.restype = ctypes.c_void_p
         self.xcb.xcb_setup_roots_iterator.restype \
         = xcb_screen_iterator_t
-        screen_iterator = self.xcb.xcb_setup_roots_iterator(setup)
+        setup = self.xcb.xcb_get_setup(conn)
+        screen_iterator = self.xcb.xcb_setup_roots_iterator(
+            ctypes.c_void_p(setup)
+        )
+        return screen_iterator.data.contents
+
+    def _get_screen_data(self):
+        screen = self._root_screen(self.conn)
+
+        self.screen_width = screen.width_in_pixels
+        self.screen_height = screen.height_in_pixels
+        # until the monitors are known, or without RandR
+        self.zones = ZoneIndex([
+            (0, 0, self.screen_width, self.screen_height)
+        ])
+
+    def _init_randr(self):
+        # the record connection is blocked in the record replies, RandR
+        # events come to a second connection watched by a thread
+        xcb_randr_location = ctypes.util.find_library('xcb-randr')
+        if not xcb_randr_location:
+            print('No xcb-randr, the zones are the root screen')
+            return
+        self.xcb_randr = ctypes.CDLL(xcb_randr_location)
+        self.xcb_randr.xcb_randr_query_version_reply.restype \
+        = ctypes.c_void_p
+        self.xcb_randr.xcb_randr_get_screen_resources_current_reply.restype \
+        = ctypes.POINTER(xcb_randr_get_screen_resources_current_reply_t)
+        self.xcb_randr.xcb_randr_get_screen_resources_current_crtcs.restype \
+        = ctypes.POINTER(ctypes.c_uint)
+        self.xcb_randr.xcb_randr_get_crtc_info_reply.restype \
+        = ctypes.POINTER(xcb_randr_get_crtc_info_reply_t)
+        self.xcb.xcb_wait_for_event.restype = ctypes.POINTER(
+            xcb_generic_event_t
+        )
+        self.xcb.xcb_poll_for_event.restype = ctypes.POINTER(
+            xcb_generic_event_t
+        )
 
-        self.screen_width \
-        = screen_iterator.data.contents.width_in_pixels
-        self.screen_height \
-        = screen_iterator.data.contents.height_in_pixels
+        self.randr_conn = self.xcb.xcb_connect(None, None)
+        present, first_event = self._query_extension(
+            self.randr_conn, b'RANDR'
+        )
+        if not present:
+            print('No RANDR extension, the zones are the root screen')
+            return
+        cookie = self.xcb_randr.xcb_randr_query_version(
+            self.randr_conn, ctypes.c_uint(1), ctypes.c_uint(3)
+        )
+        reply = self.xcb_randr.xcb_randr_query_version_reply(
+            self.randr_conn, cookie, None
+        )
+        if reply:
+            self.xcb.free(ctypes.c_void_p(reply))
+
+        root = self._root_screen(self.randr_conn).root
+        self.xcb_randr.xcb_randr_select_input(
+            self.randr_conn, xcb_window_t(root),
+            ctypes.c_ushort(XCB_RANDR_NOTIFY_MASK_SCREEN_CHANGE
+                            | XCB_RANDR_NOTIFY_MASK_CRTC_CHANGE)
+        )
+        self.xcb.xcb_flush(self.randr_conn)
+        self._update_zones(root)
+
+        thread = threading.Thread(
+            target=self._watch_randr, args=(root, first_event),
+            daemon=True
+        )
+        thread.start()
+
+    def _crtc_rects(self, root):
+        conn = self.randr_conn
+        cookie = self.xcb_randr.xcb_randr_get_screen_resources_current(
+            conn, xcb_window_t(root)
+        )
+        resources = \
+            self.xcb_randr.xcb_randr_get_screen_resources_current_reply(
+                conn, cookie, None
+            )
+        if not resources:
+            return []
+        crtcs = self.xcb_randr.xcb_randr_get_screen_resources_current_crtcs(
+            resources
+        )
+        count = resources.contents.num_crtcs
+        timestamp = resources.contents.config_timestamp
+        # all the requests are sent before the first reply is read
+        cookies = [
+            self.xcb_randr.xcb_randr_get_crtc_info(
+                conn, ctypes.c_uint(crtcs[i]), ctypes.c_uint(timestamp)
+            )
+            for i in range(count)
+        ]
+        self.xcb.free(resources)
+        rects = set()
+        for cookie in cookies:
+            info = self.xcb_randr.xcb_randr_get_crtc_info_reply(
+                conn, cookie, None
+            )
+            if not info:
+                continue
+            crtc = info.contents
+            # a disabled CRTC has no mode, clones share a rect
+            if crtc.mode and crtc.width and crtc.height:
+                rects.add((crtc.x, crtc.y, crtc.width, crtc.height))
+            self.xcb.free(info)
+        return sorted(rects)
+
+    def _update_zones(self, root):
+        rects = self._crtc_rects(root)
+        if not rects:
+            rects = [(0, 0, self.screen_width, self.screen_height)]
+        # a new index replaces the one the record loop reads
+        self.zones = ZoneIndex(rects)
+
+    def _watch_randr(self, root, first_event):
+        randr_events = (
+            first_event + XCB_RANDR_SCREEN_CHANGE_NOTIFY,
+            first_event + XCB_RANDR_NOTIFY,
+        )
+        while True:
+            event = self.xcb.xcb_wait_for_event(self.randr_conn)
+            if not event:
+                break
+            # a change of the layout comes as a burst of events, the
+            # zones are rebuilt once for all of them
+            changed = False
+            while event:
+                response_type = event.contents.response_type & 0x7f
+                changed = changed or response_type in randr_events
+                self.xcb.free(event)
+                event = self.xcb.xcb_poll_for_event(self.randr_conn)
+            if changed:
+                self._update_zones(root)
 
     def _init_record_handler(self):
         device_events = xcb_record_range_8_t(
@@ -0,0 +1,144 @@
+"""
+The decisions of the daemon commands taken on the tree mirror, apart
+from the daemon, which needs a display for Gdk, so the benchmarks can
+import them.
+"""
+
+ZOOMED_MARK = "*Z"
+
+
+def quote(name):
+    return '"%s"' % name.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def on_con(con, *commands):
+    return "; ".join('[con_id="%s"] %s' % (con.id, c) for c in commands)
+
+
+class State(object):
+    """
+    What the commands need to know before they send anything: the number
+    of windows in the scratchpad, the workspace numbers and the focused
+    workspace. It's refreshed from the tree mirror in the listening thread
+    after the events which can change it, so the commands read it without
+    a round trip.
+    """
+    def __init__(self):
+        self.scratch_leaves = 0
+        self.workspace_nums = {}
+        self.focused_num = -1
+        self.focused_leaves = 0
+        # the number of a workspace requested but not created yet
+        self.reserved_num = 0
+
+    def refresh(self, tree):
+        scratch = tree.scratchpad()
+        self.scratch_leaves = len(scratch.leaves()) if scratch else 0
+        self.workspace_nums = {w.id: w.num for w in tree.workspaces()}
+        focused = tree.find_focused()
+        workspace = focused.workspace() if focused else None
+        if workspace is not None:
+            self.focused_num = workspace.num
+            self.focused_leaves = len(workspace.leaves())
+
+    def max_num(self):
+        return max(list(self.workspace_nums.values()) + [0])
+
+    def reserve_num(self):
+        num = max(self.max_num(), self.reserved_num) + 1
+        self.reserved_num = num
+        return num
+
+
+def smart_fullscreen_command(focused, action, mode):
+    """decides on the tree which command maximizes or restores
+    the focused con, when the parent is changed the focus is moved
+    there and back in the same message, so i3 renders only the result
+    """
+    if focused is None:
+        return None
+
+    if getattr(focused, mode):
+        return "%s disable" % action
+
+    # find fullscreen among parents
+    parent = focused.parent
+    while parent and parent.type != "workspace":
+        if getattr(parent, mode):
+            return "%s; %s" % (
+                on_con(parent, "focus", "%s disable" % action),
+                on_con(focused, "focus"))
+        parent = parent.parent
+
+    # is container in stacked or tabbed environment
+    parent = focused
+    while parent and parent.type != "workspace":
+        if parent.layout in ["tabbed", "stacked"]:
+            break
+        parent = parent.parent
+
+    if parent.layout in ["tabbed", "stacked"]:
+        return "%s; %s" % (
+            on_con(parent, "focus", "%s enable" % action),
+            on_con(focused, "focus"))
+
+    if (focused.type != "workspace"
+       and len(parent.leaves()) > 1):
+        return on_con(focused, "%s enable" % action)
+    return None
+
+
+def zoomed_workspaces(tree):
+    """maps the zoomed cons of the tree to their workspaces, a full scan
+    """
+    zoomed_cons = {}
+    for c in tree.descendents():
+        if c.type != "workspace" and getattr(c, "zoomed", False):
+            workspace = c.workspace()
+            if workspace is not None:
+                zoomed_cons[c.id] = workspace.id
+    return zoomed_cons
+
+
+def update_zoomed(zoomed_cons, con_id, workspace_id):
+    """records the workspace of a zoomed con, or None when the con isn't
+    zoomed anymore, returns the workspaces whose label can change
+    """
+    changed = set()
+    old_id = zoomed_cons.pop(con_id, None)
+    if old_id is not None:
+        changed.add(old_id)
+    if workspace_id is not None:
+        zoomed_cons[con_id] = workspace_id
+        changed.add(workspace_id)
+    return changed
+
+
+def workspace_renames(tree, zoomed_cons, workspace_ids):
+    """pairs the given workspaces with a zoomed con with their name ending
+    with the mark and the others with their name without it, only the
+    workspaces whose name changes are returned
+    """
+    zoomed = set(zoomed_cons.values())
+    renames = []
+    for workspace_id in workspace_ids:
+        workspace = tree.find_by_id(workspace_id)
+        if workspace is None:
+            continue
+        name = workspace.name
+        marked = name.endswith(ZOOMED_MARK)
+        if workspace_id in zoomed and not marked:
+            renames.append((workspace, name + ZOOMED_MARK))
+        elif workspace_id not in zoomed and marked:
+            renames.append((workspace, name[:-len(ZOOMED_MARK)]))
+    return renames
+
+
+def relabel_command(renames):
+    """renames the workspaces in one message or None
+    """
+    if not renames:
+        return None
+    return "; ".join("rename workspace %s to %s" % (
+        quote(workspace.name), quote(new_name))
+        for workspace, new_name in renames)
@@ -3,15 +3,18 @@
 import os
 import sys
 import fcntl
-import errno
-from signal import signal, SIGABRT, SIGILL, SIGINT, SIGSEGV, SIGTERM
+import selectors
+import socket
+from functools import partial
+from signal import (signal, set_wakeup_fd, SIGABRT, SIGCHLD, SIGILL,
+                    SIGINT, SIGSEGV, SIGTERM)
 import random
 import string
-from subprocess import (Popen, PIPE, check_output,
-                        CalledProcessError, DEVNULL)
-from tempfile import TemporaryFile
+from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
 import re
 import threading
+import time
 
 import gi
 gi.require_version('Gdk', '3.0')
@@ -20,6 +23,9 @@ from gi.repository import Gdk
 # i3ipc 1.3.0 patched:
 # added "zoomed" to class Con > __init__ > ipc_properties
 import i3ipc
+from launcher import LauncherIndex
+from commands import (State, smart_fullscreen_command, zoomed_workspaces,
+                      update_zoomed, workspace_renames, relabel_command)
 
 
 CWD = os.path.dirname(os.path.realpath(__file__))
@@ -27,6 +33,7 @@ HOME = os.environ.get("HOME")
 SHELL = os.environ.get("SHELL", None) or "/bin/sh"
 CACHE_DIR = os.environ.get("XDG_CACHE_HOME", None) or os.path.join(HOME, ".cache")
 CACHE_RUN_FILE = os.path.join(CACHE_DIR, "dmenu_run")
+LAUNCHER_INDEX = os.path.join(CACHE_DIR, "dmenu_run.json")
 FAVOURITES = os.path.join(CWD, "..", "favourites")
 EXIT_I3_SCRIPT = os.path.join(CWD, "exit_i3.sh")
 WORKSPACES_NAMES = os.path.join(CWD, "..", "workspaces_names")
@@ -43,8 +50,8 @@ DMENU_ARGS = [ DMENU,
     "-w", DMENU_WIDTH,
 ]
 DMENU_RUN_ARGS = [
-    "-p", "'execute command:'",
-    "-sb", "'#0858b1'",
+    "-p", "execute command:",
+    "-sb", "#0858b1",
 ]
 DMENU_RENAME_ARGS = [
     "-p", "new workspace name:",
@@ -55,8 +62,11 @@ DMENU_ACTIONS_ARGS = [
     "-sb", "#BF0A37",
 ]
 FIFO = os.path.join(CWD, '..', 'fifo')
+SOCKET = os.path.join(CWD, '..', 'daemon.sock')
 PID = os.path.join(CWD, "i3_daemon.pid")
-ZOOMED_MARK = "*Z"
+PROBE_MARK = "_i3_daemon_probe"
+# seconds between the attempts to listen to a restarting i3
+LISTEN_RETRY = 1
 
 
 # Allow only one instance of the daemon
@@ -68,63 +78,163 @@ except IOError:
     sys.exit(0)
 
 
-def is_zoom_enabled():
-    # check if i3 is patched and zoom is enabled
+def is_zoom_enabled(i3):
+    # check if i3 is patched and zoom is enabled, the parser of an
+    # unpatched i3 rejects the command, the patched one runs it for
+    # the cons with the mark, i.e. for none of them
     # NOTE: add property "zoomed" to i3ipc.Con for the patched i3
-    zoom_output = check_output(["i3-msg", "zoom"], stderr=DEVNULL)
-    return "^^^^" not in str(zoom_output, 'utf-8')
+    reply = i3.command('[con_mark="%s"] zoom toggle' % PROBE_MARK)
+    return not any(r.get("parse_error", False) for r in reply)
 
 
 class Connection(object):
     def __init__(self):
-        self.is_zoom_enabled = is_zoom_enabled()
+        self.is_zoom_enabled = None
+        self.tree = None
+        self.state = State()
+        self.zoomed_cons = {}
         self.reconnect()
 
     def reconnect(self):
-        self.i3 = i3ipc.Connection()
+        # the commands run on the main loop and the menu workers at
+        # once, each request takes its own socket from the pool
+        old = getattr(self, "i3", None)
+        self.i3 = i3ipc.ConnectionPool()
+        if old is not None:
+            old.close()
+
+        # listen in a thread the events which update the tree mirror
+        # and zoom events of the patched i3, the thread reads the state
+        # once it's subscribed, the commands wait for it
+        thread = getattr(self, "thread", None)
+        if not thread or not thread.is_alive():
+            self.synced = threading.Event()
+            self.thread = threading.Thread(
+                target=self.daemon_connection
+            )
+            self.thread.daemon = True
+            self.thread.start()
+            self.synced.wait()
+        else:
+            self.resync()
+
+    def resync(self):
+        self.is_zoom_enabled = is_zoom_enabled(self.i3)
+
+        # the tree mirror is read by the commands instead of get_tree()
+        if self.tree is None:
+            self.tree = i3ipc.TreeCache(self.i3)
+        else:
+            self.tree.conn = self.i3
+            self.tree.invalidate()
+        with self.tree.locked() as tree:
+            self.state.refresh(tree)
 
-        # listen in a thread zoom events of the patched i3
         if self.is_zoom_enabled:
             self.relabel_workspaces(self.i3)
-            thread = getattr(self, "thread", None)
-            if not thread or not thread.is_alive():
-                self.thread = threading.Thread(
-                    target=self.daemon_connection
-                )
-                self.thread.daemon = True
-                self.thread.start()
 
     def daemon_connection(self):
-        # create a second connection for the listening thread
-        self.i3_daemon = i3ipc.Connection()
-        self.i3_daemon.on("window::zoomed", self.zoom_callback)
-        self.i3_daemon.on("window::close", self.zoom_callback)
-        self.i3_daemon.main()
+        # i3 closes the socket on restart, the mirror and the state are
+        # kept only by the events, so the thread listens to the new
+        # socket and reads the new tree before the commands use them
+        while True:
+            try:
+                self.listen()
+            except Exception as e:
+                print("listening to i3 failed: %s" % e)
+                time.sleep(LISTEN_RETRY)
+
+    def listen(self):
+        # create a second connection for the listening thread, the
+        # handlers run on a worker so a slow relabel doesn't hold the
+        # socket, they all read the mirror so they share one group
+        i3_daemon = i3ipc.Connection(workers=1)
+        self.i3_daemon = i3_daemon
+        if self.tree is None:
+            self.tree = i3ipc.TreeCache(self.i3)
+        self.tree.subscribe(self.i3_daemon, "state")
+        for event in ("window::new", "window::move", "window::close",
+                      "workspace"):
+            self.i3_daemon.on(event, self.state_callback, "state")
+        self.i3_daemon.on("ipc_shutdown", self.shutdown_callback, "state")
+        # the probe of the zoom comes after the subscription, the
+        # handlers are registered anyway and check it
+        self.i3_daemon.on("window::zoomed", self.zoom_callback, "state")
+        self.i3_daemon.on("window::close", self.zoom_callback, "state")
+        try:
+            # subscribe before the tree is read, the events in between
+            # wait in the socket and are applied to the new mirror
+            i3_daemon.listen()
+            self.resync()
+            self.synced.set()
+            i3_daemon.loop()
+        finally:
+            for sock in (i3_daemon.cmd_socket, i3_daemon.sub_socket):
+                if sock is not None:
+                    sock.close()
+
+    def shutdown_callback(self, i3):
+        # i3 may come back without the patch, probe it again
+        self.is_zoom_enabled = None
+
+    def zoom_enabled(self):
+        if self.is_zoom_enabled is None:
+            try:
+                self.is_zoom_enabled = is_zoom_enabled(self.i3)
+            except OSError:
+                return False
+        return self.is_zoom_enabled
+
+    def state_callback(self, i3, e):
+        if e.change == "init":
+            self.state.reserved_num = 0
+        # the mirror is patched or fetched again here, in the listening
+        # thread, instead of in the commands
+        with self.tree.locked() as tree:
+            self.state.refresh(tree)
 
     def zoom_callback(self, i3, e):
-        self.relabel_workspaces(self.i3_daemon)
-
-    def rename_workspace(self, i3, name, new_name):
-        i3.command(
-            "rename workspace %s to %s" % (name, new_name)
-        )
+        if not self.is_zoom_enabled:
+            return
+        # only the workspaces the container left or entered can change
+        con_id = e.container.id
+        workspace = None
+        if e.change == "zoomed" and e.container.zoomed:
+            con = self.tree.find_by_id(con_id)
+            workspace = con.workspace() if con else None
+        changed = update_zoomed(
+            self.zoomed_cons, con_id,
+            workspace.id if workspace is not None else None)
+        if changed:
+            self.relabel(self.i3_daemon, changed)
+
+    def relabel(self, i3, workspace_ids):
+        with self.tree.locked():
+            renames = workspace_renames(
+                self.tree, self.zoomed_cons, workspace_ids)
+        cmd = relabel_command(renames)
+        if not cmd:
+            return
+        replies = i3.command(cmd)
+        # the next zoom event can be handled before the rename events,
+        # the new names go to the mirror now so it starts from them, the
+        # rename events set the same names again later
+        with self.tree.locked():
+            for (workspace, new_name), reply in zip(renames, replies):
+                if reply.get("success", False):
+                    workspace._invalidate_index()
+                    workspace.name = new_name
 
     def relabel_workspaces(self, i3):
-        tree = i3.get_tree()
-        zoomed = [c.workspace() for c in tree.descendents()
-                    if getattr(c, "zoomed", False)]
-        for workspace in tree.workspaces():
-            name = workspace.name
-            marked = name.endswith(ZOOMED_MARK)
-            if workspace in zoomed and not marked:
-                new_name = name + ZOOMED_MARK
-                self.rename_workspace(i3, name, new_name)
-            elif workspace not in zoomed and marked:
-                new_name = name[:-len(ZOOMED_MARK)]
-                self.rename_workspace(i3, name, new_name)
+        # a full scan, the events keep the map up to date afterwards
+        with self.tree.locked() as tree:
+            self.zoomed_cons = zoomed_workspaces(tree)
+            workspace_ids = [w.id for w in tree.workspaces()]
+        self.relabel(i3, workspace_ids)
 
 
 conn = Connection()
+launcher = LauncherIndex(LAUNCHER_INDEX, CACHE_RUN_FILE, FAVOURITES)
 
 
 def reconnect():
@@ -134,27 +244,105 @@ def reconnect():
 def create_workspace():
     """creates a workspace with the next biggest number
     """
-    workspaces = conn.i3.get_workspaces()
-    num = 0
-    for w in workspaces:
-        num = w.num if num < w.num else num
+    num = conn.state.reserve_num()
     chars = "".join(
         [random.choice(string.ascii_letters) for i in range(5)]
     )
-    conn.i3.command('workspace %s' % str(num + 1) + chars)
+    conn.i3.command('workspace %s' % str(num) + chars)
+
+
+class DmenuSupervisor(object):
+    """
+    Owns the processes the daemon starts. The menus run on a small pool
+    of workers, each one feeds a dmenu and passes the selection to the
+    callback, a click on a running menu kills it through its handle.
+    The exited children are reaped after SIGCHLD wakes up the selector.
+    """
+    def __init__(self, workers=2):
+        self.lock = threading.Lock()
+        self.menus = set()
+        self.children = set()
+        self.closed = False
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def install(self, selector):
+        # the handler does nothing, the signal only writes to the pipe
+        self.wakeup, wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup, False)
+        os.set_blocking(wakeup_w, False)
+        signal(SIGCHLD, lambda *args: None)
+        set_wakeup_fd(wakeup_w)
+        selector.register(self.wakeup, selectors.EVENT_READ, self.reap)
+
+    def toggle(self):
+        """kills and returns True if a menu is running
+        """
+        with self.lock:
+            menus = list(self.menus)
+        for proc in menus:
+            proc.kill()
+        return len(menus) > 0
+
+    def spawn(self, cmd, **kwargs):
+        proc = Popen(cmd, close_fds=True, **kwargs)
+        with self.lock:
+            self.children.add(proc)
+        return proc
+
+    def reap(self, wakeup=None):
+        if wakeup is not None:
+            try:
+                while os.read(wakeup, 512):
+                    pass
+            except BlockingIOError:
+                pass
+        with self.lock:
+            for proc in list(self.children):
+                if proc.poll() is not None:
+                    self.children.discard(proc)
+
+    def close(self):
+        """drops the queued menus and kills the open ones, the workers
+        are joined at the exit and would wait for the user otherwise
+        """
+        with self.lock:
+            self.closed = True
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.toggle()
+
+    def menu(self, cmd, options, callback, *args):
+        self.pool.submit(self._run_menu, cmd, options, callback, args)
+
+    def _run_menu(self, cmd, options, callback, args):
+        # nothing waits for the future, the errors are printed here
+        try:
+            proc = Popen(cmd, stdin=PIPE, stdout=PIPE, close_fds=True)
+            with self.lock:
+                if self.closed:
+                    proc.kill()
+                self.menus.add(proc)
+            try:
+                selection, _ = proc.communicate(options.encode("utf-8"))
+            finally:
+                with self.lock:
+                    self.menus.discard(proc)
+            selection = str(selection, "utf-8").strip()
+            if proc.returncode != 0 or not selection:
+                return
+            callback(selection, *args)
+        except Exception as e:
+            print("menu %s failed: %s" % (cmd[0], e))
 
 
 def was_dmenu_running():
-    """kills and returns True if dmenu is running 
+    """kills and returns True if dmenu is running
     """
-    try:
-        pid = check_output(["pidof", DMENU])
-    except CalledProcessError:
-        return False
-    else:
-        #os.kill(int(pid), SIGTERM)
-        os.system("killall dmenu");
-        return True
+    return supervisor.toggle()
+
+
+def on_execute(selection):
+    supervisor.spawn([SHELL, "-c", selection])
+    launcher.record(selection)
 
 
 def execute_command(x=None):
@@ -165,70 +353,29 @@ def execute_command(x=None):
     if x is not None:
         cmd.extend(["-x", str(int(x) - int(DMENU_OFFSET))])
 
-    if not os.path.isfile(CACHE_RUN_FILE):
-        favourites = ""
-        with open(FAVOURITES, "r") as buf:
-            favourites = buf.read()
-        favourites = list(filter(None, favourites.split("\n")))
-        # get all executables
-        paths = os.environ["PATH"].split(":")
-        list_dir = lambda p : os.listdir(p) if os.path.isdir(p) else []
-        is_file = lambda x, y : os.path.isfile(os.path.join(x, y))
-        bins = []
-        for p in paths:
-            for f in list_dir(p):
-                if is_file(p, f):
-                    bins.append(f)
-        # remove dublicates in bins from favourites, keep favourites first
-        options = favourites + list(set(bins) - set(favourites))
-        data = "\n".join(options)
-        with open(CACHE_RUN_FILE, "w") as buf:
-            buf.write(data)
-    # open dmenu
-    env = os.environ.copy()
-    cmd = "%s < %s | %s" % (" ".join(cmd), CACHE_RUN_FILE, SHELL)
-    Popen(
-        cmd, env=env, shell=True, stdin=None,
-        stdout=None, stderr=None, close_fds=True
-    )
+    launcher.update(os.environ["PATH"].split(":"))
+    with open(CACHE_RUN_FILE, "r") as buf:
+        options = buf.read()
+    supervisor.menu(cmd, options, on_execute)
 
 
-def async_rename(names, current_num, x):
-    cmd = DMENU_ARGS + DMENU_RENAME_ARGS
-    if x is not None:
-        cmd.extend(["-x", str(int(x) - 200)])
-    input_name = b''
-    with TemporaryFile("w") as temp:
-        temp.write(names)
-        temp.seek(0)
-        try:
-            input_name = check_output(cmd, stdin=temp)
-        except CalledProcessError:
-            return False
-
-    input_name = str(input_name, 'utf-8')
+def on_rename(input_name, current_num):
     input_num = re.findall(r'^\d+', input_name)
 
     # If number of input name has some of existing workspaces,
     # reassign number
     if len(input_num) > 0:
         input_num = int(input_num[0])
-        workspaces = conn.i3.get_workspaces()
-        reassign = False
-        max_num = 0
-        for w in workspaces:
-            max_num = w.num if max_num < w.num else max_num
-            if input_num == w.num and input_num != current_num:
-                reassign = True
+        nums = conn.state.workspace_nums.values()
+        max_num = conn.state.max_num()
+        reassign = input_num in nums and input_num != current_num
         if reassign:
             input_name = re.sub(r'^\d+', str(max_num + 1), input_name)
     conn.i3.command("rename workspace to %s" % input_name)
 
 
 def rename_workspace(x=None):
-    tree = conn.i3.get_tree()
-    focused = tree.find_focused()
-    current_num = focused.workspace().num
+    current_num = conn.state.focused_num
     current_num = current_num if current_num > -1 else ""
     names = ""
     with open(WORKSPACES_NAMES, "r") as buf:
@@ -236,21 +383,10 @@ def rename_workspace(x=None):
     for n in names_list:
         names += str(current_num) + n
 
-    thread = threading.Thread(
-        target=async_rename, args=(names, current_num, x)
-    )
-    thread.daemon = True
-    thread.start()
-
-
-SCRATCH_NAME = "__i3_scratch"
-
-def get_scratch():
-    tree = conn.i3.get_tree()
-    try:
-        return next(c for c in tree.descendents() if c.name == SCRATCH_NAME)
-    except StopIteration:
-        return None
+    cmd = DMENU_ARGS + DMENU_RENAME_ARGS
+    if x is not None:
+        cmd.extend(["-x", str(int(x) - 200)])
+    supervisor.menu(cmd, names, on_rename, current_num)
 
 
 def cut():
@@ -262,9 +398,7 @@ def paste():
 
 
 def scratch_to_from():
-    scratch = get_scratch()
-    leaves = scratch.leaves()
-    if len(leaves) > 0:
+    if conn.state.scratch_leaves > 0:
         paste()
     else:
         cut()
@@ -274,25 +408,18 @@ def move_to_new_workspace():
     """moves a con from scratch to a new workspace
     or cuts a focused con and pastes it on a new workspace
     """
-    scratch = get_scratch()
-    leaves = scratch.leaves()
-    if len(leaves) > 0:
+    if conn.state.scratch_leaves > 0:
         create_workspace()
         paste()
         return
-    tree = conn.i3.get_tree()
-    focused = tree.find_focused()
-    leaves = focused.workspace().leaves()
-    if len(leaves) > 0:
+    if conn.state.focused_leaves > 0:
         cut()
         create_workspace()
         paste()
 
 
 def smart_run(x=None):
-    scratch = get_scratch()
-    leaves = scratch.leaves()
-    if len(leaves) > 0:
+    if conn.state.scratch_leaves > 0:
         paste()
     else:
         was_dmenu_running()
@@ -300,55 +427,20 @@ def smart_run(x=None):
 
 
 def smart_fullscreen():
-    if is_zoom_enabled():
-        maximize_action="zoom"
-        maximize_mode="zoomed"
+    if conn.zoom_enabled():
+        maximize_action = "zoom"
+        maximize_mode = "zoomed"
     else:
-        maximize_action="fullscreen"
-        maximize_mode="fullscreen_mode"
-
-    tree = conn.i3.get_tree()
-    focused = tree.find_focused()
-
-    is_focused_fullscreen = getattr(focused, maximize_mode)
-    if is_focused_fullscreen:
-        conn.i3.command("%s disable" % maximize_action)
-        return
+        maximize_action = "fullscreen"
+        maximize_mode = "fullscreen_mode"
 
-    is_parent_fullscreen = 0
-    parent = focused.parent
-    # find fullscreen among parents
-    if not is_focused_fullscreen:
-        while parent and parent.type != "workspace" :
-            is_parent_fullscreen = getattr(parent, maximize_mode)
-            if not is_parent_fullscreen:
-                parent = parent.parent
-            else:
-                break
-
-    if is_parent_fullscreen:
-        parent.command("focus")
-        parent.command("%s disable" % maximize_action)
-        focused.command("focus")
-        return
-
-    # is container in stacked or tabbed environment
-    parent = focused
-    while parent and parent.type != "workspace" :
-        if not parent.layout in ["tabbed", "stacked"]:
-            parent = parent.parent
-        else:
-            break
-
-    if parent.layout in ["tabbed", "stacked"]:
-        parent.command("focus")
-        parent.command("%s enable" % maximize_action)
-        focused.command("focus")
-        return
-
-    if (focused.type != "workspace"
-       and len(parent.leaves()) > 1):
-        focused.command("%s enable" % maximize_action)
+    # the mirror is walked in this thread while the listening thread
+    # patches it, the command is decided under its lock
+    with conn.tree.locked() as tree:
+        cmd = smart_fullscreen_command(
+            tree.find_focused(), maximize_action, maximize_mode)
+    if cmd:
+        conn.i3.command(cmd)
 
 
 def fullscreen(): conn.i3.command("fullscreen")
@@ -383,11 +475,7 @@ def close():
     conn.i3.command("kill")
 
 def exit_i3():
-    cmd = ["sh", EXIT_I3_SCRIPT]
-    Popen(
-        cmd, stdin=False, shell=False,
-        stdout=None, stderr=None, close_fds=True
-    )
+    supervisor.spawn(["sh", EXIT_I3_SCRIPT])
 
 
 MAIN_ACTIONS = [
@@ -415,21 +503,7 @@ AUX_ACTIONS = [
     "exit i3",
 ]
 
-def async_con(actions, x):
-    cmd = DMENU_ARGS + DMENU_ACTIONS_ARGS
-    if x is not None:
-        cmd.extend(["-x", str(int(x) - int(DMENU_OFFSET))])
-    input_action = None
-    with TemporaryFile("w") as temp:
-        temp.write(actions)
-        temp.seek(0)
-        try:
-            input_action = check_output(cmd, stdin=temp)
-        except CalledProcessError:
-            return False
-    if not input_action:
-        return False
-    input_action = str(input_action, 'utf-8').rstrip()
+def on_con_action(input_action):
     actions_map = {
         MAIN_ACTIONS[0]: fullscreen,
         MAIN_ACTIONS[1]: floating,
@@ -445,111 +519,196 @@ def async_con(actions, x):
         AUX_ACTIONS[3]: close,
         AUX_ACTIONS[4]: exit_i3,
     }
-    actions_map[input_action]()
+    action = actions_map.get(input_action)
+    if action is not None:
+        action()
 
 
 def con_actions(x=None):
-    scratch = get_scratch()
-    leaves = scratch.leaves()
     actions = []
     actions += MAIN_ACTIONS
-    if len(leaves) > 0:
+    if conn.state.scratch_leaves > 0:
         actions += FULL_SCRATCH_ACTIONS
     else:
         actions += EMPTY_SCRATCH_ACTIONS
     actions += AUX_ACTIONS
     actions = "\n".join(actions)
 
-    thread = threading.Thread(
-        target=async_con, args=(actions, x)
-    )
-    thread.daemon = True
-    thread.start()
+    cmd = DMENU_ARGS + DMENU_ACTIONS_ARGS
+    if x is not None:
+        cmd.extend(["-x", str(int(x) - int(DMENU_OFFSET))])
+    supervisor.menu(cmd, actions, on_con_action)
 
 
-# create and listen fifo
-# usage:
-# echo command_name > /path/to/fifo
+LMB = "1"
+RMB = "3"
 
-def clean(*args):
-    try:
-        os.remove(FIFO)
-    except OSError:
-        pass
-    else:
-        print("FIFO deleted")
 
+def run_menu(x=None):
+    was_dmenu_running() or execute_command(x=x)
 
-clean()
 
+def rename_menu(x=None):
+    was_dmenu_running() or rename_workspace(x=x)
 
-for sig in (SIGABRT, SIGILL, SIGINT, SIGSEGV, SIGTERM):
-    signal(sig, clean)
 
+def smart_create(x=None):
+    create_workspace()
+    smart_run(x=x)
 
-try:
-    os.mkfifo(FIFO)
-except OSError as oe:
-    if oe.errno != errno.EEXIST:
-        raise
 
+def con_menu(x=None):
+    was_dmenu_running() or con_actions(x=x)
 
-LMB = "1"
-RMB = "3"
 
-menu_block_re = re.compile("(menu_block) (\d+) (\d+)")
-move_block_re = re.compile("(move_block) (\d+) (\d+)")
-con_block_re = re.compile("(con_block) (\d+) (\d+)")
+# "<block> <button> <x>" sent on clicks by i3bar blocks
+BLOCK_COMMANDS = {
+    "menu_block": {LMB: run_menu, RMB: rename_menu},
+    "move_block": {LMB: smart_create, RMB: lambda x: move_to_new_workspace()},
+    "con_block": {LMB: con_menu, RMB: lambda x: smart_fullscreen()},
+}
 
-while True:
-    cmd = ""
-    print("Opening FIFO...")
-    with open(FIFO) as fifo:
-        print("FIFO opened")
-        while True:
-            data = fifo.read()
-            if len(data) == 0:
-                print("Writer closed")
-                # break loop in order to do not load cpu
-                break
-            else:
-                cmd = data.rstrip()
-    # process commands to fifo
-    print(cmd)
-    menu_block_match = menu_block_re.match(cmd)
-    move_block_match = move_block_re.match(cmd)
-    con_block_match = con_block_re.match(cmd)
-
-    if menu_block_match and menu_block_match.group(2) == LMB or cmd == "exec":
-        x = menu_block_match.group(3) if menu_block_match else None
-        was_dmenu_running() or execute_command(x=x)
-    elif menu_block_match and menu_block_match.group(2) == RMB or cmd == "rename_workspace":
-        x = menu_block_match.group(3) if menu_block_match else None
-        was_dmenu_running() or rename_workspace(x=x)
-    elif move_block_match and move_block_match.group(2) == LMB or cmd == "smart_create":
-        x = move_block_match.group(3) if move_block_match else None
-        create_workspace()
-        smart_run(x=x)
-    elif move_block_match and move_block_match.group(2) == RMB or cmd == "move_to_new":
-        move_to_new_workspace()
-    elif con_block_match and con_block_match.group(2) == LMB:
-        x = con_block_match.group(3)
-        was_dmenu_running() or con_actions(x=x)
-    elif con_block_match and con_block_match.group(2) == RMB or cmd == "smart_fullscreen":
-        smart_fullscreen()
-    elif cmd == "create_workspace":
-        create_workspace()
-    elif cmd == "exit_i3":
-        exit_i3()
-    elif cmd == "scratch_to_from":
-        scratch_to_from()
-    elif cmd == "smart_run":
-        smart_run()
-    elif cmd == "reconnect":
-        reconnect()
+COMMANDS = {
+    "exec": run_menu,
+    "rename_workspace": rename_menu,
+    "smart_create": smart_create,
+    "move_to_new": move_to_new_workspace,
+    "smart_fullscreen": smart_fullscreen,
+    "create_workspace": create_workspace,
+    "exit_i3": exit_i3,
+    "scratch_to_from": scratch_to_from,
+    "smart_run": smart_run,
+    "reconnect": reconnect,
+}
+
+
+def dispatch(cmd):
+    """runs a command and returns the status line for the caller
+    """
+    args = cmd.split()
+    if not args:
+        return "error: empty command"
+    name = args[0]
+    if name in BLOCK_COMMANDS:
+        if len(args) < 3 or not args[1].isdigit() or not args[2].isdigit():
+            return "error: usage %s <button> <x>" % name
+        handler = BLOCK_COMMANDS[name].get(args[1], None)
+        if handler is None:
+            return "ignored"
+        handler = partial(handler, args[2])
+    elif name in COMMANDS:
+        handler = COMMANDS[name]
     else:
-        pass
+        return "error: unknown command %s" % name
+    try:
+        handler()
+    except Exception as e:
+        return "error: %s" % e
+    return "ok"
+
+
+# listen a unix socket and the fifo
+# usage:
+# echo command_name | nc -U /path/to/daemon.sock
+# echo command_name > /path/to/fifo
 
+def clean(*args):
+    for path in (SOCKET, FIFO):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        else:
+            print("%s deleted" % path)
+    if args:
+        # called as a signal handler
+        supervisor.close()
+        sys.exit(0)
+
+
+class CommandServer(object):
+    """Accepts any number of clients on the unix socket, every line a
+    client sends is a command and gets a status line back. The fifo is
+    kept for the old clients, it is opened for writing too, so it never
+    reaches EOF and stays registered in the selector.
+    """
+    def __init__(self, socket_path, fifo_path):
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen(16)
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ, self.accept)
+
+        os.mkfifo(fifo_path)
+        self.fifo = os.open(fifo_path, os.O_RDWR | os.O_NONBLOCK)
+        self.selector.register(self.fifo, selectors.EVENT_READ, self.read_fifo)
+
+    def accept(self, server):
+        client, _ = server.accept()
+        client.setblocking(False)
+        self.buffers[client] = b""
+        self.selector.register(client, selectors.EVENT_READ, self.read_client)
+
+    def close_client(self, client):
+        self.selector.unregister(client)
+        del self.buffers[client]
+        client.close()
+
+    def reply(self, client, cmd):
+        print(cmd)
+        status = dispatch(cmd)
+        try:
+            client.sendall((status + "\n").encode("utf-8"))
+        except OSError:
+            pass
 
+    def read_client(self, client):
+        try:
+            data = client.recv(4096)
+        except OSError:
+            data = b""
+        if not data:
+            # a command without the trailing newline
+            rest = self.buffers[client].strip()
+            if rest:
+                self.reply(client, str(rest, "utf-8", "replace"))
+            self.close_client(client)
+            return
+        lines = (self.buffers[client] + data).split(b"\n")
+        self.buffers[client] = lines.pop()
+        for line in lines:
+            self.reply(client, str(line, "utf-8", "replace").strip())
+
+    def read_fifo(self, fifo):
+        try:
+            data = os.read(fifo, 4096)
+        except BlockingIOError:
+            return
+        # writes up to PIPE_BUF are atomic, so a read doesn't end
+        # in the middle of a command of a writer
+        for line in str(data, "utf-8", "replace").splitlines():
+            cmd = line.strip()
+            if cmd:
+                print(cmd)
+                dispatch(cmd)
+
+    def serve_forever(self):
+        while True:
+            for key, _ in self.selector.select():
+                key.data(key.fileobj)
+
+
+clean()
+
+
+supervisor = DmenuSupervisor()
+for sig in (SIGABRT, SIGILL, SIGINT, SIGSEGV, SIGTERM):
+    signal(sig, clean)
 
 
+server = CommandServer(SOCKET, FIFO)
+supervisor.install(server.selector)
+server.serve_forever()
@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 
+import asyncio
 import errno
 import struct
 import json
 import socket
 import os
 import re
+import select
 import subprocess
+import threading
+import traceback
+import weakref
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from enum import Enum
 
 
@@ -114,21 +123,92 @@ class BindingEvent(object):
         self.binding = BindingInfo(data['binding'])
 
 
+class _HandlerPool(object):
+    """
+    Runs the event handlers on worker threads. The handlers of one group
+    run one at a time in the order of the events, the groups run
+    concurrently. Once max_pending handlers are queued submit() blocks,
+    so the reading of the socket stops and i3 buffers the events.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.max_pending = max_pending
+        self.pending = 0
+        self.peak_pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._cond = threading.Condition()
+        self._groups = {}
+
+    def submit(self, group, handler, args):
+        with self._cond:
+            while self.pending >= self.max_pending:
+                self._cond.wait()
+            queue = self._groups.get(group)
+            idle = queue is None
+            if idle:
+                queue = self._groups[group] = deque()
+            queue.append((handler, args))
+            self.pending += 1
+            self.peak_pending = max(self.peak_pending, self.pending)
+        # a group has one drain task at most, which keeps the order
+        if idle:
+            self._executor.submit(self._drain, group)
+
+    def _drain(self, group):
+        while True:
+            with self._cond:
+                queue = self._groups[group]
+                if not queue:
+                    del self._groups[group]
+                    return
+                handler, args = queue.popleft()
+            try:
+                handler(*args)
+            except Exception:
+                traceback.print_exc()
+            with self._cond:
+                self.pending -= 1
+                self._cond.notify_all()
+
+    def depths(self):
+        with self._cond:
+            return {group: len(queue) for group, queue in self._groups.items()}
+
+    def join(self):
+        with self._cond:
+            while self.pending:
+                self._cond.wait()
+
+
 class _PubSub(object):
 
     def __init__(self, conn):
         self.conn = conn
-        self._subscriptions = []
+        self.pool = None
+        self._subscriptions = {}
 
-    def subscribe(self, detailed_event, handler):
+    def subscribe(self, detailed_event, handler, group=None):
         event = detailed_event.replace('-', '_')
         detail = ''
 
         if detailed_event.count('::') > 0:
             [event, detail] = detailed_event.split('::')
 
-        self._subscriptions.append({'event': event, 'detail': detail,
-                                    'handler': handler})
+        # without a group the calls of a handler are ordered among
+        # themselves only
+        self._subscriptions.setdefault(event, []).append({
+            'event': event, 'detail': detail, 'handler': handler,
+            'group': handler if group is None else group})
+
+    def wants(self, event, detail=None):
+        """
+        Whether any handler takes the event with the given change, None
+        matches any change.
+        """
+        for s in self._subscriptions.get(event, ()):
+            if not s['detail'] or detail is None or s['detail'] == detail:
+                return True
+        return False
 
     def emit(self, event, data):
         detail = ''
@@ -136,13 +216,13 @@ class _PubSub(object):
         if data and hasattr(data, 'change'):
             detail = data.change
 
-        for s in self._subscriptions:
-            if s['event'] == event:
-                if not s['detail'] or s['detail'] == detail:
-                    if data:
-                        s['handler'](self.conn, data)
-                    else:
-                        s['handler'](self.conn)
+        for s in self._subscriptions.get(event, ()):
+            if not s['detail'] or s['detail'] == detail:
+                args = (self.conn, data) if data else (self.conn,)
+                if self.pool is None:
+                    s['handler'](*args)
+                else:
+                    self.pool.submit(s['group'], s['handler'], args)
 
 # this is for compatability with i3ipc-glib
 
@@ -162,92 +242,128 @@ class _PropsObject(object):
         setattr(object.__getattribute__(self, "_obj"), name, value)
 
 
-class Connection(object):
-    MAGIC = 'i3-ipc'  # safety string for i3-ipc
-    _chunk_size = 1024  # in bytes
-    _timeout = 0.5  # in seconds
-    _struct_header = '<%dsII' % len(MAGIC.encode('utf-8'))
-    _struct_header_size = struct.calcsize(_struct_header)
-
-    def __init__(self, socket_path=None):
-        if not socket_path:
-            socket_path = os.environ.get("I3SOCK")
-
-        if not socket_path:
-            try:
-                socket_path = subprocess.check_output(
-                    ['i3', '--get-socketpath'],
-                    close_fds=True, universal_newlines=True).strip()
-            except:
-                raise Exception('Failed to retrieve the i3 IPC socket path')
-
-        self._pubsub = _PubSub(self)
-        self.props = _PropsObject(self)
-        self.subscriptions = 0
-        self.socket_path = socket_path
-        self.cmd_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.cmd_socket.connect(self.socket_path)
-        self.sub_socket = None
+def _get_socket_path(socket_path=None):
+    if not socket_path:
+        socket_path = os.environ.get("I3SOCK")
 
-    def _pack(self, msg_type, payload):
-        """
-        Packs the given message type and payload. Turns the resulting
-        message into a byte string.
-        """
-        pb = payload.encode()
-        s = struct.pack('=II', len(pb), msg_type.value)
-        return self.MAGIC.encode() + s + pb
-
-    def _unpack(self, data):
-        """
-        Unpacks the given byte string and parses the result from JSON.
-        Returns None on failure and saves data into "self.buffer".
-        """
-        msg_magic, msg_length, msg_type = self._unpack_header(data)
-        msg_size = self._struct_header_size + msg_length
-        # XXX: Message shouldn't be any longer than the data
-        payload = data[self._struct_header_size:msg_size]
-        return payload.decode('utf-8', 'replace')
-
-    def _unpack_header(self, data):
-        """
-        Unpacks the header of given byte string.
-        """
-        return struct.unpack(self._struct_header,
-                             data[:self._struct_header_size])
-
-    def _recv_robust(self, sock, size):
-        """
-        Receive size from sock, and retry if the recv() call was interrupted.
-        (this is only required for python2 compatability)
-        """
+    if not socket_path:
+        try:
+            socket_path = subprocess.check_output(
+                ['i3', '--get-socketpath'],
+                close_fds=True, universal_newlines=True).strip()
+        except:
+            raise Exception('Failed to retrieve the i3 IPC socket path')
+
+    return socket_path
+
+
+# the event bit -> the name of the event and the factory of its object
+_event_types = {
+    Event.WORKSPACE: ('workspace', WorkspaceEvent),
+    Event.OUTPUT: ('output', lambda data, conn: GenericEvent(data)),
+    Event.MODE: ('mode', lambda data, conn: GenericEvent(data)),
+    Event.WINDOW: ('window', WindowEvent),
+    Event.BARCONFIG_UPDATE: (
+        'barconfig_update', lambda data, conn: BarconfigUpdateEvent(data)),
+    Event.BINDING: ('binding', lambda data, conn: BindingEvent(data)),
+}
+
+_event_bits = {name: bit for bit, (name, _) in _event_types.items()}
+
+# i3 writes the change first, it's read without parsing the payload
+_change_re = re.compile(r'\s*\{\s*"change"\s*:\s*"([^"\\]*)"')
+
+
+def _event_type(msg_type):
+    """
+    Returns the name and the factory of an event message type or None
+    for the events that are not implemented.
+    """
+    return _event_types.get(1 << (msg_type & 0x7f))
+
+
+def _event_from_message(msg_type, data, conn):
+    """
+    Returns the name and the object of an event message or (None, None)
+    for the events that are not implemented.
+    """
+    event_type = _event_type(msg_type)
+    if event_type is None:
+        return None, None
+    name, factory = event_type
+    return name, factory(data, conn)
+
+
+class _FrameReader(object):
+    """
+    Reads messages from a socket into a reusable buffer with recv_into().
+    The bytes past the end of a message are kept for the next call, so
+    pipelined messages are never lost and the payload is decoded from the
+    buffer without intermediate copies.
+    """
+
+    def __init__(self, sock, magic, header, size=64 * 1024):
+        self.sock = sock
+        self.magic = magic.encode()
+        self.header = header
+        self.header_size = struct.calcsize(header)
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def _recv_into(self, view):
         while True:
             try:
-                return sock.recv(size)
+                return self.sock.recv_into(view)
             except socket.error as e:
                 if e.errno != errno.EINTR:
                     raise
 
-    def _ipc_recv(self, sock):
-        data = self._recv_robust(sock, 14)
-
-        if len(data) == 0:
-            # EOF
-            return '', 0
-
-        msg_magic, msg_length, msg_type = self._unpack_header(data)
-        msg_size = self._struct_header_size + msg_length
-        while len(data) < msg_size:
-            data += self._recv_robust(sock, msg_length)
-        return self._unpack(data), msg_type
-
-    def _ipc_send(self, sock, message_type, payload):
-        sock.sendall(self._pack(message_type, payload))
-        data, msg_type = self._ipc_recv(sock)
-        return data
-
-    def message(self, message_type, payload):
-        return self._ipc_send(self.cmd_socket, message_type, payload)
+    def _fill(self, size):
+        while self.end - self.start < size:
+            if self.start + size > len(self.buffer):
+                pending = self.end - self.start
+                source = memoryview(self.buffer)[self.start:self.end]
+                if size > len(self.buffer):
+                    self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+                memoryview(self.buffer)[:pending] = source
+                self.start = 0
+                self.end = pending
+            received = self._recv_into(memoryview(self.buffer)[self.end:])
+            if received == 0:
+                return False
+            self.end += received
+        return True
+
+    def read(self):
+        """
+        Returns the payload and the type of the next message or None
+        on EOF.
+        """
+        if not self._fill(self.header_size):
+            return None
+        msg_magic, msg_length, msg_type = struct.unpack_from(
+            self.header, self.buffer, self.start)
+        if msg_magic != self.magic:
+            raise ValueError('Invalid i3-ipc message header')
+        if not self._fill(self.header_size + msg_length):
+            return None
+        payload_start = self.start + self.header_size
+        payload_end = payload_start + msg_length
+        payload = str(memoryview(self.buffer)[payload_start:payload_end],
+                      'utf-8', 'replace')
+        if payload_end == self.end:
+            self.start = self.end = 0
+        else:
+            self.start = payload_end
+        return payload, msg_type
+
+
+class _Requests(object):
+    """
+    The requests of the command socket, built on message() of the class
+    they are mixed in.
+    """
 
     def command(self, payload):
         data = self.message(MessageType.COMMAND, payload)
@@ -284,20 +400,66 @@ class Connection(object):
         data = self.message(MessageType.GET_TREE, '')
         return Con(json.loads(data), None, self)
 
+
+class Connection(_Requests):
+    MAGIC = 'i3-ipc'  # safety string for i3-ipc
+    _chunk_size = 1024  # in bytes
+    _timeout = 0.5  # in seconds
+    _struct_header = '<%dsII' % len(MAGIC.encode('utf-8'))
+    _struct_header_size = struct.calcsize(_struct_header)
+
+    def __init__(self, socket_path=None, workers=0, max_pending=1024):
+        """
+        With workers the handlers run on a pool of that many threads
+        instead of the thread of main(), see on() for their order.
+        """
+        socket_path = _get_socket_path(socket_path)
+
+        self._readers = weakref.WeakKeyDictionary()
+        self._pubsub = _PubSub(self)
+        if workers:
+            self._pubsub.pool = _HandlerPool(workers, max_pending)
+        self.received = 0
+        self.skipped = 0
+        self.props = _PropsObject(self)
+        self.subscriptions = 0
+        self.socket_path = socket_path
+        self.cmd_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.cmd_socket.connect(self.socket_path)
+        self.sub_socket = None
+
+    def _pack(self, msg_type, payload):
+        """
+        Packs the given message type and payload. Turns the resulting
+        message into a byte string.
+        """
+        pb = payload.encode()
+        s = struct.pack('=II', len(pb), msg_type.value)
+        return self.MAGIC.encode() + s + pb
+
+    def _ipc_recv(self, sock):
+        reader = self._readers.get(sock)
+        if reader is None:
+            reader = _FrameReader(sock, self.MAGIC, self._struct_header)
+            self._readers[sock] = reader
+
+        frame = reader.read()
+        if frame is None:
+            # EOF
+            return '', 0
+        return frame
+
+    def _ipc_send(self, sock, message_type, payload):
+        sock.sendall(self._pack(message_type, payload))
+        data, msg_type = self._ipc_recv(sock)
+        return data
+
+    def message(self, message_type, payload):
+        return self._ipc_send(self.cmd_socket, message_type, payload)
+
     def subscribe(self, events):
-        events_obj = []
-        if events & Event.WORKSPACE:
-            events_obj.append("workspace")
-        if events & Event.OUTPUT:
-            events_obj.append("output")
-        if events & Event.MODE:
-            events_obj.append("mode")
-        if events & Event.WINDOW:
-            events_obj.append("window")
-        if events & Event.BARCONFIG_UPDATE:
-            events_obj.append("barconfig_update")
-        if events & Event.BINDING:
-            events_obj.append("binding")
+        events_obj = [name for bit, (name, _) in sorted(_event_types.items())
+                      if events & bit]
 
         data = self._ipc_send(
             self.sub_socket, MessageType.SUBSCRIBE, json.dumps(events_obj))
@@ -305,7 +467,12 @@ class Connection(object):
         self.subscriptions |= events
         return result
 
-    def on(self, detailed_event, handler):
+    def on(self, detailed_event, handler, group=None):
+        """
+        Registers a handler of the event. With the worker pool the
+        handlers of the same group run one at a time in the order of the
+        events, a handler without a group is ordered only with itself.
+        """
         event = detailed_event.replace('-', '_')
 
         if detailed_event.count('::') > 0:
@@ -313,36 +480,47 @@ class Connection(object):
 
         # special case: ipc-shutdown is not in the protocol
         if event == 'ipc_shutdown':
-            self._pubsub.subscribe(event, handler)
+            self._pubsub.subscribe(event, handler, group)
             return
 
-        event_type = 0
-        if event == "workspace":
-            event_type = Event.WORKSPACE
-        elif event == "output":
-            event_type = Event.OUTPUT
-        elif event == "mode":
-            event_type = Event.MODE
-        elif event == "window":
-            event_type = Event.WINDOW
-        elif event == "barconfig_update":
-            event_type = Event.BARCONFIG_UPDATE
-        elif event == "binding":
-            event_type = Event.BINDING
+        event_type = _event_bits.get(event)
 
         if not event_type:
             raise Exception('event not implemented')
 
         self.subscriptions |= event_type
 
-        self._pubsub.subscribe(detailed_event, handler)
+        self._pubsub.subscribe(detailed_event, handler, group)
+
+    def event_stats(self):
+        """
+        The counts of the received events and of the ones dropped before
+        parsing, with the handler pool also the queued handlers in total,
+        the peak of the queue and the queue of each busy group.
+        """
+        stats = {'received': self.received, 'skipped': self.skipped}
+        pool = self._pubsub.pool
+        if pool is not None:
+            stats.update(pending=pool.pending, peak_pending=pool.peak_pending,
+                         groups=pool.depths())
+        return stats
 
     def main(self):
+        self.listen()
+        self.loop()
+
+    def listen(self):
+        """
+        Opens the event socket and subscribes to the events of the
+        handlers, i3 queues the events from here on until loop() reads
+        them, so the state read in between misses none of them.
+        """
         self.sub_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.sub_socket.connect(self.socket_path)
 
         self.subscribe(self.subscriptions)
 
+    def loop(self):
         while True:
             if self.sub_socket is None:
                 break
@@ -354,34 +532,25 @@ class Connection(object):
                 self._pubsub.emit('ipc_shutdown', None)
                 break
 
-            data = json.loads(data)
-            msg_type = 1 << (msg_type & 0x7f)
-            event_name = ''
-            event = None
-
-            if msg_type == Event.WORKSPACE:
-                event_name = 'workspace'
-                event = WorkspaceEvent(data, self)
-            elif msg_type == Event.OUTPUT:
-                event_name = 'output'
-                event = GenericEvent(data)
-            elif msg_type == Event.MODE:
-                event_name = 'mode'
-                event = GenericEvent(data)
-            elif msg_type == Event.WINDOW:
-                event_name = 'window'
-                event = WindowEvent(data, self)
-            elif msg_type == Event.BARCONFIG_UPDATE:
-                event_name = 'barconfig_update'
-                event = BarconfigUpdateEvent(data)
-            elif msg_type == Event.BINDING:
-                event_name = 'binding'
-                event = BindingEvent(data)
-            else:
+            self.received += 1
+            event_type = _event_type(msg_type)
+            if event_type is None:
                 # we have not implemented this event
                 continue
 
-            self._pubsub.emit(event_name, event)
+            # the window events come for every change once any of them
+            # is subscribed, the others are dropped unparsed
+            event_name, factory = event_type
+            match = _change_re.match(data)
+            if not self._pubsub.wants(event_name,
+                                      match.group(1) if match else None):
+                self.skipped += 1
+                continue
+
+            self._pubsub.emit(event_name, factory(json.loads(data), self))
+
+        if self._pubsub.pool is not None:
+            self._pubsub.pool.join()
 
     def main_quit(self):
         if self.sub_socket:
@@ -389,77 +558,479 @@ class Connection(object):
         self.sub_socket = None
 
 
-class Rect(object):
+class ConnectionPool(_Requests):
+    """
+    A thread-safe replacement of the command socket of Connection. Every
+    request takes an idle socket or opens a new one, up to max_size, so
+    the threads never interleave their frames and don't wait for each
+    other's replies. An idle socket closed by i3 is dropped before it's
+    used, a request which finds the socket dead looks the socket path up
+    again and is retried once on a new socket. A request which takes
+    longer than the timeout raises socket.timeout.
+    """
+    MAGIC = Connection.MAGIC
+    _struct_header = Connection._struct_header
+    _pack = Connection._pack
+
+    def __init__(self, socket_path=None, max_size=4, timeout=2.0):
+        self._socket_path_arg = socket_path
+        self.socket_path = _get_socket_path(socket_path)
+        self.props = _PropsObject(self)
+        self.max_size = max_size
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._size = 0
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock, _FrameReader(sock, self.MAGIC, self._struct_header)
+
+    def _is_alive(self, sock):
+        # nothing is sent to an idle command socket, so it's readable
+        # only when i3 has closed it
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                while self._idle:
+                    conn = self._idle.pop()
+                    if self._is_alive(conn[0]):
+                        return conn
+                    conn[0].close()
+                    self._size -= 1
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                if not self._cond.wait(self.timeout):
+                    raise socket.timeout('No idle i3 IPC connection')
+        try:
+            return self._connect()
+        except OSError:
+            self._release(None)
+            raise
+
+    def _release(self, conn, healthy=False):
+        with self._cond:
+            if healthy:
+                self._idle.append(conn)
+            else:
+                if conn is not None:
+                    conn[0].close()
+                self._size -= 1
+            self._cond.notify()
+
+    def _check_socket_path(self):
+        socket_path = _get_socket_path(self._socket_path_arg)
+        with self._cond:
+            if socket_path == self.socket_path:
+                return
+            self.socket_path = socket_path
+            while self._idle:
+                self._idle.pop()[0].close()
+                self._size -= 1
 
-    def __init__(self, data):
-        self.x = data['x']
-        self.y = data['y']
-        self.height = data['height']
-        self.width = data['width']
+    def message(self, message_type, payload):
+        for retry in (False, True):
+            try:
+                conn = self._acquire()
+            except socket.timeout:
+                raise
+            except OSError:
+                if retry:
+                    raise
+                self._check_socket_path()
+                continue
+            sock, reader = conn
+            try:
+                sock.sendall(self._pack(message_type, payload))
+                frame = reader.read()
+                if frame is None:
+                    raise ConnectionResetError('i3 closed the IPC socket')
+            except socket.timeout:
+                self._release(conn)
+                raise
+            except OSError:
+                self._release(conn)
+                if retry:
+                    raise
+                self._check_socket_path()
+                continue
+            self._release(conn, True)
+            return frame[0]
+
+    def close(self):
+        with self._cond:
+            while self._idle:
+                self._idle.pop()[0].close()
+                self._size -= 1
+
+
+class AsyncEvent(namedtuple('AsyncEvent', ['type', 'change', 'payload'])):
+    """
+    An event of AsyncConnection.subscribe(), the type is the name of the
+    event, the payload is the event object passed to the handlers of
+    Connection.on().
+    """
+    __slots__ = ()
+
+
+class AsyncConnection(object):
+    """
+    asyncio variant of Connection. Replies of i3 come in the order of the
+    requests, so several requests can be in flight on the command socket,
+    each one is resolved by the next reply from a FIFO of futures.
+    Events are read from a second socket into a bounded queue which stops
+    the reading while the consumer lags behind.
+    """
+    MAGIC = Connection.MAGIC
+    _struct_header = Connection._struct_header
+    _struct_header_size = Connection._struct_header_size
+    _pack = Connection._pack
+
+    def __init__(self, socket_path=None, max_events=256):
+        self.socket_path = _get_socket_path(socket_path)
+        self.max_events = max_events
+        self._writer = None
+        self._pending = deque()
+        self._reader_task = None
+        self._event_writers = []
+
+    async def connect(self):
+        reader, self._writer = await asyncio.open_unix_connection(
+            self.socket_path)
+        self._reader_task = asyncio.ensure_future(self._read_replies(reader))
+
+    async def close(self):
+        for writer in [self._writer] + self._event_writers:
+            if writer is not None:
+                writer.close()
+        if self._reader_task is not None:
+            await self._reader_task
+
+    async def _read_message(self, reader):
+        try:
+            header = await reader.readexactly(self._struct_header_size)
+            msg_magic, msg_length, msg_type = struct.unpack(
+                self._struct_header, header)
+            if msg_magic != self.MAGIC.encode():
+                raise ValueError('Invalid i3-ipc message header')
+            payload = await reader.readexactly(msg_length)
+        except asyncio.IncompleteReadError:
+            return None
+        return payload.decode('utf-8', 'replace'), msg_type
+
+    async def _read_replies(self, reader):
+        try:
+            while True:
+                message = await self._read_message(reader)
+                if message is None:
+                    break
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_result(message[0])
+        finally:
+            # the requests in flight fail with the socket, the replies of
+            # a broken stream can't be matched to them anymore
+            while self._pending:
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError('The i3 IPC socket is closed'))
+
+    def message(self, message_type, payload):
+        """
+        Sends a message without waiting for the previous replies, returns
+        a future of the raw reply.
+        """
+        if self._writer is None:
+            raise ConnectionError('Not connected')
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append(future)
+        self._writer.write(self._pack(message_type, payload))
+        return future
+
+    async def command(self, payload):
+        data = await self.message(MessageType.COMMAND, payload)
+        return json.loads(data, object_hook=CommandReply)
+
+    async def get_version(self):
+        data = await self.message(MessageType.GET_VERSION, '')
+        return json.loads(data, object_hook=VersionReply)
+
+    async def get_outputs(self):
+        data = await self.message(MessageType.GET_OUTPUTS, '')
+        return json.loads(data, object_hook=OutputReply)
+
+    async def get_workspaces(self):
+        data = await self.message(MessageType.GET_WORKSPACES, '')
+        return json.loads(data, object_hook=WorkspaceReply)
+
+    async def get_tree(self):
+        data = await self.message(MessageType.GET_TREE, '')
+        return Con(json.loads(data), None, self)
+
+    async def subscribe(self, event_names):
+        """
+        Subscribes to the events by their names ("window", "workspace",
+        ...) on a socket of its own and yields them as AsyncEvent.
+        """
+        reader, writer = await asyncio.open_unix_connection(
+            self.socket_path)
+        self._event_writers.append(writer)
+        writer.write(
+            self._pack(MessageType.SUBSCRIBE, json.dumps(event_names)))
+        queue = asyncio.Queue(self.max_events)
+
+        async def read_events():
+            reply = await self._read_message(reader)
+            if reply is None or not json.loads(reply[0])['success']:
+                return
+            while True:
+                message = await self._read_message(reader)
+                if message is None:
+                    return
+                data, msg_type = message
+                name, event = _event_from_message(
+                    msg_type, json.loads(data), self)
+                if name is not None:
+                    # waits while the queue is full
+                    await queue.put(AsyncEvent(
+                        name, getattr(event, 'change', None), event))
+
+        async def read_until_closed():
+            # the consumer stops on None or raises the error of the
+            # reading, it would wait for the next event forever otherwise
+            try:
+                await read_events()
+            except Exception as e:
+                await queue.put(e)
+            else:
+                await queue.put(None)
+
+        task = asyncio.ensure_future(read_until_closed())
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+        finally:
+            task.cancel()
+            writer.close()
+            self._event_writers.remove(writer)
+
+
+class Rect(namedtuple('Rect', ['x', 'y', 'width', 'height'])):
+    __slots__ = ()
+
+
+@lru_cache(maxsize=4096)
+def _make_rect(x, y, width, height):
+    return Rect(x, y, width, height)
+
+
+def _rect(data):
+    # most of the cons share a handful of rects, they share the tuples too
+    return _make_rect(data['x'], data['y'], data['width'], data['height'])
+
+
+_type_names = {0: "root", 1: "output", 2: "con", 3: "con",
+               4: "workspace", 5: "dockarea"}
+
+_compile_pattern = lru_cache(maxsize=256)(re.compile)
+
+
+class _ConIndex(object):
+    """
+    The lookup tables of the descendents of a con, built by the first
+    query. The lists keep the cons in the order of descendents().
+    """
+    __slots__ = ('descendents', 'positions', 'by_id', 'by_window', 'marks',
+                 'classes', 'instances', 'roles', 'names', 'workspaces')
+
+    def __init__(self, con):
+        self.descendents = con.descendents()
+        self.positions = {}
+        self.by_id = {}
+        self.by_window = {}
+        self.marks = {}
+        self.classes = {}
+        self.instances = {}
+        self.roles = {}
+        self.names = {}
+        self.workspaces = []
+        for i, c in enumerate(self.descendents):
+            self.positions[c] = i
+            self.by_id.setdefault(c.id, c)
+            if c.window is not None:
+                self.by_window.setdefault(c.window, c)
+            for mark in c.marks:
+                self.marks.setdefault(mark, []).append(c)
+            if c.window_class:
+                self.classes.setdefault(c.window_class, []).append(c)
+            if c.window_instance:
+                self.instances.setdefault(c.window_instance, []).append(c)
+            if c.window_role:
+                self.roles.setdefault(c.window_role, []).append(c)
+            if c.name:
+                self.names.setdefault(c.name, []).append(c)
+            if c.type == "workspace" and not c.name.startswith('__'):
+                self.workspaces.append(c)
+
+    def search(self, table, pattern):
+        # the pattern is matched once per distinct value
+        regex = _compile_pattern(pattern)
+        matches = {}
+        for value, cons in table.items():
+            if regex.search(value):
+                for c in cons:
+                    matches[c] = None
+        return sorted(matches, key=self.positions.__getitem__)
+
+
+# a slot which is not materialized from the data yet
+_unset = object()
 
 
 class Con(object):
+    """
+    A container of the layout tree. The scalar properties and the rects
+    are copied from the parsed reply, the children and the window
+    properties are built from it on the first access, so a lookup which
+    walks the focus path doesn't build the rest of the tree. The reply
+    of a child is released once the child is built.
+    """
+    ipc_properties = ('border', 'current_border_width', 'focused',
+                      'fullscreen_mode', 'id', 'layout', 'marks', 'name',
+                      'orientation', 'percent', 'type', 'urgent', 'window',
+                      'num', 'scratchpad_state', 'zoomed')
+
+    __slots__ = ipc_properties + (
+        '_conn', 'parent', '_props', '_focus',
+        '_nodes', '_floating_nodes', '_nodes_data', '_floating_nodes_data',
+        '_window_properties', '_window_class', '_window_instance',
+        '_window_role', 'rect', 'window_rect', 'deco_rect', '_index',
+        '__weakref__')
 
     def __init__(self, data, parent, conn):
-        self.props = _PropsObject(self)
         self._conn = conn
         self.parent = parent
+        self._props = None
+        self._index = None
 
         # set simple properties
-        ipc_properties = ['border', 'current_border_width', 'focused',
-                          'fullscreen_mode', 'id', 'layout', 'marks', 'name',
-                          'orientation', 'percent', 'type', 'urgent', 'window',
-                          'num', 'scratchpad_state', 'zoomed']
-        for attr in ipc_properties:
-            if attr in data:
-                setattr(self, attr, data[attr])
-            else:
-                setattr(self, attr, None)
+        get = data.get
+        for attr in self.ipc_properties:
+            setattr(self, attr, get(attr))
 
         # XXX in 4.12, marks is an array (old property was a string "mark")
         if not self.marks:
             self.marks = []
-            if 'mark' in data and data['mark']:
+            if get('mark'):
                 self.marks.append(data['mark'])
 
         # XXX this is for compatability with 4.8
         if isinstance(self.type, int):
-            if self.type == 0:
-                self.type = "root"
-            elif self.type == 1:
-                self.type = "output"
-            elif self.type == 2 or self.type == 3:
-                self.type = "con"
-            elif self.type == 4:
-                self.type = "workspace"
-            elif self.type == 5:
-                self.type = "dockarea"
+            self.type = _type_names.get(self.type, self.type)
 
         # set complex properties
-        self.nodes = []
-        for n in data['nodes']:
-            self.nodes.append(Con(n, self, conn))
-
-        self.floating_nodes = []
-        for n in data['floating_nodes']:
-            self.floating_nodes.append(Con(n, self, conn))
-
-        self.window_class = None
-        self.window_instance = None
-        self.window_role = None
-        if 'window_properties' in data:
-            if 'class' in data['window_properties']:
-                self.window_class = data['window_properties']['class']
-            if 'instance' in data['window_properties']:
-                self.window_instance = data['window_properties']['instance']
-            if 'window_role' in data['window_properties']:
-                self.window_role = data['window_properties']['window_role']
-
-        self.rect = Rect(data['rect'])
-        if 'window_rect' in data:
-            self.window_rect = Rect(data['window_rect'])
-        if 'deco_rect' in data:
-            self.deco_rect = Rect(data['deco_rect'])
+        self._focus = get('focus')
+        self._nodes = None
+        self._floating_nodes = None
+        self._nodes_data = data['nodes']
+        self._floating_nodes_data = get('floating_nodes', [])
+
+        self._window_properties = get('window_properties')
+        self._window_class = _unset
+        self._window_instance = _unset
+        self._window_role = _unset
+
+        self.rect = _rect(data['rect'])
+        rect = get('window_rect')
+        self.window_rect = _rect(rect) if rect else None
+        rect = get('deco_rect')
+        self.deco_rect = _rect(rect) if rect else None
+
+    @property
+    def props(self):
+        if self._props is None:
+            self._props = _PropsObject(self)
+        return self._props
+
+    @property
+    def nodes(self):
+        if self._nodes is None:
+            self._nodes = [Con(n, self, self._conn)
+                           for n in self._nodes_data]
+            self._nodes_data = None
+        return self._nodes
+
+    @nodes.setter
+    def nodes(self, value):
+        self._nodes = value
+        self._nodes_data = None
+
+    @property
+    def floating_nodes(self):
+        if self._floating_nodes is None:
+            self._floating_nodes = [Con(n, self, self._conn)
+                                    for n in self._floating_nodes_data]
+            self._floating_nodes_data = None
+        return self._floating_nodes
+
+    @floating_nodes.setter
+    def floating_nodes(self, value):
+        self._floating_nodes = value
+        self._floating_nodes_data = None
+
+    def _window_property(self, name):
+        if self._window_properties is None:
+            return None
+        return self._window_properties.get(name)
+
+    @property
+    def window_class(self):
+        if self._window_class is _unset:
+            self._window_class = self._window_property('class')
+        return self._window_class
+
+    @window_class.setter
+    def window_class(self, value):
+        self._window_class = value
+
+    @property
+    def window_instance(self):
+        if self._window_instance is _unset:
+            self._window_instance = self._window_property('instance')
+        return self._window_instance
+
+    @window_instance.setter
+    def window_instance(self, value):
+        self._window_instance = value
+
+    @property
+    def window_role(self):
+        if self._window_role is _unset:
+            self._window_role = self._window_property('window_role')
+        return self._window_role
+
+    @window_role.setter
+    def window_role(self, value):
+        self._window_role = value
 
     def root(self):
         if not self.parent:
@@ -486,17 +1057,26 @@ class Con(object):
         collect_descendents(self)
         return descendents
 
-    def leaves(self):
-        leaves = []
+    def _get_index(self):
+        if self._index is None:
+            self._index = _ConIndex(self)
+        return self._index
 
-        for c in self.descendents():
-            if not c.nodes and c.type == "con" and c.parent.type != "dockarea":
-                leaves.append(c)
+    def _invalidate_index(self):
+        # the indexes of the ancestors contain this con too
+        con = self
+        while con is not None:
+            con._index = None
+            con = con.parent
 
-        return leaves
+    def leaves(self):
+        return [c for c in self._get_index().descendents
+                if not c.nodes and c.type == "con"
+                and c.parent.type != "dockarea"]
 
     def command(self, command):
-        self._conn.command('[con_id="{}"] {}'.format(self.id, command))
+        return self._conn.command(
+            '[con_id="{}"] {}'.format(self.id, command))
 
     def command_children(self, command):
         if not len(self.nodes):
@@ -506,59 +1086,59 @@ class Con(object):
         for c in self.nodes:
             commands.append('[con_id="{}"] {};'.format(c.id, command))
 
-        self._conn.command(' '.join(commands))
+        return self._conn.command(' '.join(commands))
 
     def workspaces(self):
-        workspaces = []
-
-        def collect_workspaces(con):
-            if con.type == "workspace" and not con.name.startswith('__'):
-                workspaces.append(con)
-                return
-
-            for c in con.nodes:
-                collect_workspaces(c)
-
-        collect_workspaces(self.root())
-        return workspaces
+        return list(self.root()._get_index().workspaces)
 
     def find_focused(self):
+        # i3 puts the focused child first in the focus list, following
+        # it builds only the cons on the path and their siblings, the
+        # whole tree is searched if the flags no longer match the list
+        con = self
+        while True:
+            focus = con._focus
+            if not focus:
+                break
+            con = next((c for c in con.nodes + con.floating_nodes
+                        if c.id == focus[0]), None)
+            if con is None:
+                break
+            if con.focused:
+                return con
         try:
             return next(c for c in self.descendents() if c.focused)
         except StopIteration:
             return None
 
     def find_by_id(self, id):
-        try:
-            return next(c for c in self.descendents() if c.id == id)
-        except StopIteration:
-            return None
+        return self._get_index().by_id.get(id)
 
     def find_by_window(self, window):
-        try:
-            return next(c for c in self.descendents() if c.window == window)
-        except StopIteration:
-            return None
+        return self._get_index().by_window.get(window)
 
     def find_by_role(self, pattern):
-        return [c for c in self.descendents()
-                if c.window_role and re.search(pattern, c.window_role)]
+        index = self._get_index()
+        return index.search(index.roles, pattern)
 
     def find_named(self, pattern):
-        return [c for c in self.descendents()
-                if c.name and re.search(pattern, c.name)]
+        index = self._get_index()
+        return index.search(index.names, pattern)
 
     def find_classed(self, pattern):
-        return [c for c in self.descendents()
-                if c.window_class and re.search(pattern, c.window_class)]
+        index = self._get_index()
+        return index.search(index.classes, pattern)
+
+    def find_instanced(self, pattern):
+        index = self._get_index()
+        return index.search(index.instances, pattern)
 
     def find_marked(self, pattern=".*"):
-        pattern = re.compile(pattern)
-        return [c for c in self.descendents()
-                if any(pattern.search(mark) for mark in c.marks)]
+        index = self._get_index()
+        return index.search(index.marks, pattern)
 
     def find_fullscreen(self):
-        return [c for c in self.descendents()
+        return [c for c in self._get_index().descendents
                 if c.type == 'con' and c.fullscreen_mode]
 
     def workspace(self):
@@ -602,3 +1182,183 @@ class Con(object):
                 break
 
         return scratch
+
+
+class TreeCache(object):
+    """
+    A mirror of the layout tree. It is fetched once with GET_TREE and then
+    patched in place from the window, workspace and output events, so
+    reading the tree doesn't cost a round trip.
+
+    The events which change the structure in a way that can't be derived
+    from their payload (a new or moved window, a new workspace, output
+    changes), an event about an unknown container and ipc_shutdown mark
+    the mirror as stale, the next read fetches the whole tree again.
+    The generation is incremented on every change of the mirror, the
+    query indexes of the changed containers and their ancestors are
+    dropped.
+    """
+    _window_properties = ['border', 'current_border_width',
+                          'fullscreen_mode', 'layout', 'marks', 'name',
+                          'orientation', 'percent', 'urgent', 'window',
+                          'scratchpad_state', 'zoomed', 'window_class',
+                          'window_instance', 'window_role', 'rect']
+    _structural_window_changes = ['new', 'move', 'floating']
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.generation = 0
+        self._lock = threading.RLock()
+        self._tree = None
+        self._cons = {}
+        self._focused = None
+
+    def subscribe(self, conn, group=None):
+        """
+        Registers the handlers which keep the mirror up to date on the
+        given connection, they must come before other handlers that read
+        the mirror. With the handler pool of the connection the handlers
+        which read the mirror must be in the same group.
+        """
+        group = self if group is None else group
+        conn.on('window', self._on_window, group)
+        conn.on('workspace', self._on_workspace, group)
+        conn.on('output', self._on_output, group)
+        conn.on('ipc_shutdown', self._on_shutdown, group)
+
+    def get(self):
+        """
+        Returns the live mirror, it is patched by the listening thread
+        while it is read, walk it under locked() in the other threads.
+        """
+        with self._lock:
+            if self._tree is None:
+                self._resync()
+            return self._tree
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the mirror while the block reads it, so the events are not
+        applied and the query indexes are not dropped in the meantime.
+        """
+        with self._lock:
+            if self._tree is None:
+                self._resync()
+            yield self._tree
+
+    def find_by_id(self, con_id):
+        with self._lock:
+            if self._tree is None:
+                self._resync()
+            return self._cons.get(con_id)
+
+    def invalidate(self):
+        with self._lock:
+            self._tree = None
+            self._cons = {}
+            self._focused = None
+            self.generation += 1
+
+    def _resync(self):
+        self._tree = self.conn.get_tree()
+        self._cons = {self._tree.id: self._tree}
+        self._focused = self._tree if self._tree.focused else None
+        for c in self._tree.descendents():
+            self._cons[c.id] = c
+            if c.focused:
+                self._focused = c
+        self.generation += 1
+
+    def _remove(self, con):
+        con._invalidate_index()
+        parent = con.parent
+        if parent is not None:
+            if con in parent.nodes:
+                parent.nodes.remove(con)
+            elif con in parent.floating_nodes:
+                parent.floating_nodes.remove(con)
+            if parent._focus:
+                parent._focus = [i for i in parent._focus if i != con.id]
+        for c in [con] + con.descendents():
+            self._cons.pop(c.id, None)
+            if c is self._focused:
+                self._focused = None
+        return parent
+
+    def _set_focus(self, con):
+        if self._focused is not None:
+            self._focused.focused = False
+        con.focused = True
+        self._focused = con
+        # like i3, every con on the path goes first in the focus list of
+        # its parent, find_focused() follows the lists
+        child = con
+        parent = con.parent
+        while parent is not None:
+            focus = parent._focus or []
+            if not focus or focus[0] != child.id:
+                parent._focus = [child.id] + [
+                    i for i in focus if i != child.id]
+            child = parent
+            parent = parent.parent
+
+    def _on_window(self, i3, e):
+        with self._lock:
+            if self._tree is None:
+                return
+            con = self._cons.get(e.container.id)
+            if e.change in self._structural_window_changes or con is None:
+                self.invalidate()
+                return
+            if e.change == 'close':
+                parent = self._remove(con)
+                # i3 closes the split containers left without children
+                while (parent is not None and parent.type == 'con'
+                       and not parent.nodes and not parent.floating_nodes
+                       and parent.window is None):
+                    parent = self._remove(parent)
+            elif e.change == 'focus':
+                self._set_focus(con)
+            else:
+                con._invalidate_index()
+                for attr in self._window_properties:
+                    setattr(con, attr, getattr(e.container, attr))
+            self.generation += 1
+
+    def _on_workspace(self, i3, e):
+        with self._lock:
+            if self._tree is None:
+                return
+            con = self._cons.get(e.current.id) if e.current else None
+            if con is None:
+                self.invalidate()
+                return
+            if e.change == 'focus':
+                focused = e.current.find_focused()
+                if focused is None and e.current.focused:
+                    focused = e.current
+                focused = self._cons.get(focused.id) if focused else None
+                if focused is None:
+                    self.invalidate()
+                    return
+                self._set_focus(focused)
+            elif e.change == 'empty':
+                self._remove(con)
+            elif e.change == 'rename':
+                con._invalidate_index()
+                con.name = e.current.name
+                con.num = e.current.num
+            elif e.change in ['urgent', 'zoomed']:
+                con.urgent = e.current.urgent
+                con.zoomed = e.current.zoomed
+            else:
+                self.invalidate()
+                return
+            self.generation += 1
+
+    def _on_output(self, i3, e):
+        self.invalidate()
+
+    def _on_shutdown(self, i3):
+        self.invalidate()
@@ -0,0 +1,122 @@
+import os
+import json
+import time
+from tempfile import NamedTemporaryFile
+
+
+# a launch counts half as much after a week
+HALF_LIFE = 7 * 24 * 60 * 60
+
+
+def write_atomic(path, data):
+    with NamedTemporaryFile("w", dir=os.path.dirname(path),
+                            delete=False) as buf:
+        buf.write(data)
+    os.replace(buf.name, path)
+
+
+class LauncherIndex(object):
+    """
+    The executables of $PATH ranked for dmenu: the favourites first, then
+    by how often and how recently they were launched, then by name.
+
+    The executables are stored per directory with the mtime of the
+    directory, so only the directories which changed are listed again.
+    The ranked list is rewritten only when the executables or the launch
+    stats change.
+    """
+    def __init__(self, index_path, run_path, favourites_path):
+        self.index_path = index_path
+        self.run_path = run_path
+        self.favourites_path = favourites_path
+        self.dirs = {}
+        self.stats = {}
+        try:
+            with open(index_path, "r") as buf:
+                data = json.load(buf)
+            self.dirs = data["dirs"]
+            self.stats = data["stats"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def scan(self, path):
+        bins = []
+        for entry in os.scandir(path):
+            try:
+                if entry.is_file():
+                    bins.append(entry.name)
+            except OSError:
+                pass
+        return bins
+
+    def refresh(self, paths):
+        """lists again the directories which changed since the last scan,
+        returns True if the executables changed
+        """
+        changed = False
+        dirs = {}
+        for path in paths:
+            if path in dirs:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            cached = self.dirs.get(path)
+            if cached is not None and cached["mtime"] == mtime:
+                dirs[path] = cached
+                continue
+            try:
+                dirs[path] = {"mtime": mtime, "bins": self.scan(path)}
+            except OSError:
+                continue
+            changed = True
+        changed = changed or set(dirs) != set(self.dirs)
+        self.dirs = dirs
+        return changed
+
+    def score(self, name, now):
+        stats = self.stats.get(name)
+        if stats is None:
+            return 0
+        return stats["count"] * 0.5 ** ((now - stats["last"]) / HALF_LIFE)
+
+    def favourites(self):
+        try:
+            with open(self.favourites_path, "r") as buf:
+                return list(filter(None, buf.read().split("\n")))
+        except OSError:
+            return []
+
+    def ranked(self):
+        favourites = self.favourites()
+        bins = set()
+        for d in self.dirs.values():
+            bins.update(d["bins"])
+        bins -= set(favourites)
+        now = time.time()
+        return favourites + sorted(
+            bins, key=lambda name: (-self.score(name, now), name))
+
+    def save(self):
+        write_atomic(self.run_path, "\n".join(self.ranked()))
+        write_atomic(self.index_path, json.dumps(
+            {"dirs": self.dirs, "stats": self.stats}))
+
+    def update(self, paths):
+        """makes the ranked list up to date before dmenu reads it"""
+        if self.refresh(paths) or not os.path.isfile(self.run_path):
+            self.save()
+
+    def record(self, cmd):
+        """learns from a selected command line"""
+        args = cmd.split()
+        if not args:
+            return
+        name = os.path.basename(args[0])
+        stats = self.stats.setdefault(name, {"count": 0, "last": 0})
+        now = time.time()
+        # the count decays between the launches the same way the score does
+        stats["count"] = self.score(name, now) + 1
+        stats["last"] = now
+        self.save()
@@ -0,0 +1,120 @@
+from typing import Any
+import os
+import json
+import hashlib
+import tempfile
+import time
+
+from sway_ipc import TreeIndex
+
+
+HOME = os.environ.get('HOME', '')
+DATA_DIR = os.environ.get('XDG_DATA_HOME', None) or os.path.join(
+    HOME, '.local', 'share')
+STORE_DIR = os.path.join(DATA_DIR, 'srws')
+LAYOUTS_DIR = os.path.join(STORE_DIR, 'layouts')
+INDEX_PATH = os.path.join(STORE_DIR, 'index.json')
+
+# the only fields load_workspace reads
+LAYOUT_FIELDS = (
+    'id',
+    'name',
+    'type',
+    'layout',
+    'orientation',
+    'rect',
+    'deco_rect',
+    'app_id',
+    'app_args',
+)
+
+
+def prune(node: dict[str, Any], ids: list[int] | None = None) -> dict[str, Any]:
+    """Copies the fields used by a restore, the con ids are renumbered in
+    the document order, so the same layout saved twice is the same JSON.
+    """
+    if ids is None:
+        ids = [0]
+    ids[0] += 1
+    pruned = {f: node[f] for f in LAYOUT_FIELDS if f in node}
+    pruned['id'] = ids[0]
+    pruned['nodes'] = [prune(n, ids) for n in node['nodes']]
+    return pruned
+
+
+def dump_compact(data: Any) -> str:
+    return json.dumps(data, separators=(',', ':'), sort_keys=True)
+
+
+def write_atomic(path: str, data: str) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def read_index() -> dict[str, Any]:
+    if not os.path.isfile(INDEX_PATH):
+        return {}
+    with open(INDEX_PATH, 'r') as f:
+        return dict(json.load(f))
+
+
+def store_layout(workspace_con: dict[str, Any]) -> str:
+    """Stores a pruned workspace once per content and returns its hash."""
+    data = dump_compact(prune(workspace_con))
+    digest = hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+    path = os.path.join(LAYOUTS_DIR, digest + '.json')
+    if not os.path.exists(path):
+        write_atomic(path, data)
+    return digest
+
+
+def load_layout(digest: str) -> dict[str, Any]:
+    with open(os.path.join(LAYOUTS_DIR, digest + '.json'), 'r') as f:
+        return dict(json.load(f))
+
+
+def count_apps(node: dict[str, Any]) -> int:
+    count = 1 if node.get('app_id', None) else 0
+    return count + sum(count_apps(n) for n in node['nodes'])
+
+
+def workspace_output(index: TreeIndex, workspace: dict[str, Any]) -> str | None:
+    if 'output' in workspace:
+        return str(workspace['output'])
+    parent = index.parent(workspace)
+    while parent is not None and parent['type'] != 'output':
+        parent = index.parent(parent)
+    return None if parent is None else str(parent['name'])
+
+
+def save_session(name: str, tree: dict[str, Any]) -> list[dict[str, Any]]:
+    """Stores the layouts of every non empty workspace of the tree and
+    records them under the name in the index.
+    """
+    os.makedirs(LAYOUTS_DIR, exist_ok=True)
+    index = TreeIndex(tree)
+    entries = []
+    for workspace in index.workspaces:
+        if workspace['name'].startswith('__') or not workspace['nodes']:
+            continue
+        entries.append({
+            'name': workspace['name'],
+            'output': workspace_output(index, workspace),
+            'layout': store_layout(workspace),
+            'apps': count_apps(workspace),
+        })
+    sessions = read_index()
+    sessions[name] = {'saved': int(time.time()), 'workspaces': entries}
+    write_atomic(INDEX_PATH, json.dumps(sessions, indent=1, sort_keys=True))
+    return entries
+
+
+def load_session(
+    name: str,
+) -> list[tuple[dict[str, Any], dict[str, Any]]] | None:
+    session = read_index().get(name, None)
+    if session is None:
+        return None
+    return [(e, load_layout(e['layout'])) for e in session['workspaces']]
@@ -12,33 +12,55 @@ from subprocess import Popen
 
 from sway_ipc import (
     get_socket,
-    get_tree,
-    get_workspaces,
-    command,
-    find_con_parent_workspace,
+    pack,
+    read,
+    read_frame,
+    MessageType,
+    CommandPlan,
+    quote,
+    subscribe_window,
+    TreeIndex,
 )
+import snapshots
+from tracer import Tracer, LaunchHistory
 
 
 class WorkspaceManager:
     LAUNCH_TIMOUT_SECONDS = 10
+    STAGING_WORKSPACE = 'srws-staging'
+    ANCHOR_MARK = '_srws_anchor'
     EXECUTABLES = {
         'Alacritty': 'alacritty',
     }
     cwd: str | None = None
     layout_rect: dict[str, int] | None = None
     workspace_rect: dict[str, int] | None = None
-    extracted_app_con_ids: list[int] = []
+    layout_index: TreeIndex | None = None
+    dry_run = False
+
+    def __init__(self, trace_path: str | None = None) -> None:
+        self.extracted_app_con_ids: list[int] = []
+        self.tracer = Tracer(trace_path)
+        self.history = LaunchHistory(self.LAUNCH_TIMOUT_SECONDS)
+
+    def query(self, sock: socket, msg_type: MessageType) -> Any:
+        name = msg_type.name.lower()
+        with self.tracer.span('ipc', name):
+            sock.sendall(pack(msg_type, ''))
+            _, payload = read_frame(sock)
+        with self.tracer.span('parse', name, size=len(payload)):
+            return json.loads(payload)
 
     def save_workspace(self, save_path: str, workspace_name: str) -> None:
         if os.path.exists(save_path) and not os.path.isfile(save_path):
             print(f'The specified path {save_path} is not a file')
             sys.exit(1)
         sock = get_socket()
-        tree = get_tree(sock)
-        search_name_fn = lambda n: n['name'] == workspace_name
-        search_focused_fn = lambda n: n['focused']
-        callback_fn = search_name_fn if workspace_name else search_focused_fn
-        _, _, workspace_con = find_con_parent_workspace(tree, callback_fn)
+        index = TreeIndex(self.query(sock, MessageType.GET_TREE))
+        if workspace_name:
+            workspace_con = index.workspace_names.get(workspace_name, None)
+        else:
+            workspace_con = index.focused_workspace
         if workspace_con is None:
             print('No workspace found.')
             sys.exit(1)
@@ -46,8 +68,8 @@ class WorkspaceManager:
             json.dump(workspace_con, f, indent=4)
         print(f'Saved JSON to {save_path}')
 
-    def run_detached(self, cmd: str) -> None:
-        Popen(
+    def run_detached(self, cmd: str) -> Popen[bytes]:
+        return Popen(
             cmd,
             shell=True,
             cwd=self.cwd,
@@ -73,71 +95,94 @@ class WorkspaceManager:
         height_px = int(node_height / l_rect['height'] * w_rect['height'])
         return width_px, height_px
 
-    def split(self, sock: socket, node: dict[str, Any]) -> None:
+    def run_plan(self, sock: socket | None, plan: CommandPlan) -> None:
+        if not len(plan):
+            return
+        labels = [label for _, _, (label, _) in plan.commands]
+        with self.tracer.span('ipc', 'command', commands=labels):
+            results = plan.execute(sock)
+        if plan.dry_run:
+            # the compiled plan is printed, no command has run
+            return
+        for (label, _), res in results:
+            print(f'{label} result:', res)
+
+    def split(self, plan: CommandPlan, node: dict[str, Any]) -> None:
         layout = node['layout']
         orientation = node['orientation']
         if orientation == 'none':
             orientation = 'horizontal'
-        res = command(sock, f'split {orientation}')
-        print('Split result:', res)
+        plan.add(f'split {orientation}', key=('Split', node))
         if layout != 'none':
-            res = command(sock, f'layout {layout}')
-            print('Layout result:', res)
+            plan.add(f'layout {layout}', key=('Layout', node))
 
-    def find_apps(
+    def wait_new_window(
         self,
-        nodes: list[dict[str, Any]],
-        apps: list[dict[str, Any]],
-    ) -> list[dict[str, Any]]:
-        for node in nodes:
-            if 'app_id' in node:
-                apps.append(node)
-            self.find_apps(node['nodes'], apps)
-        return apps
-
-    def count_real_apps(self, sock: socket) -> int:
-        tree = get_tree(sock)
-        _, _, workspace = find_con_parent_workspace(
-            tree, lambda n: n['focused'])
-        apps = self.find_apps(workspace['nodes'], [])
-        return len(apps)
-
-    def launch(self, sock: socket, node: dict[str, Any]) -> None:
-        cmd = node['app_id']
+        sub_sock: socket,
+        timeout: float,
+    ) -> dict[str, Any] | None:
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            sub_sock.settimeout(remaining)
+            try:
+                event = read(sub_sock)
+            except TimeoutError:
+                return None
+            if event.get('change') == 'new':
+                return cast(dict[str, Any], event['container'])
+
+    def get_launch_cmd(self, node: dict[str, Any]) -> str:
+        cmd = cast(str, node['app_id'])
         if cmd in self.EXECUTABLES:
             cmd = self.EXECUTABLES[cmd]
         args = node.get('app_args', None)
         if args:
             cmd += ' ' + args
+        return cmd
+
+    def launch(self, sub_sock: socket | None, node: dict[str, Any]) -> None:
+        cmd = self.get_launch_cmd(node)
         print('Launching app:', cmd)
-        apps_count = self.count_real_apps(sock)
+        if sub_sock is None:
+            # dry run, the saved con id stands in for the real one
+            node['real_app_node'] = {'id': node['id']}
+            return
+        app_id = node['app_id']
+        start = time.perf_counter()
         self.run_detached(cmd)
-        new_apps_count = apps_count
-        start_time = time.time()
-        while new_apps_count <= apps_count:
-            time.sleep(0.1)
-            new_apps_count = self.count_real_apps(sock)
-            end_time = time.time()
-            if end_time - start_time > self.LAUNCH_TIMOUT_SECONDS:
-                print('Launching app takes too long. Exiting.')
-                sys.exit(1)
-        tree = get_tree(sock)
-        real_app_node, _, _ = find_con_parent_workspace(
-            tree, lambda n: n['focused'])
+        real_app_node = self.wait_new_window(
+            sub_sock, self.history.deadline(app_id))
+        if real_app_node is None:
+            self.tracer.record(
+                'timeout', app_id, time.perf_counter() - start)
+            print('Launching app takes too long. Exiting.')
+            self.finish()
+            sys.exit(1)
+        self.mapped(node, real_app_node, time.perf_counter() - start)
+
+    def mapped(
+        self,
+        node: dict[str, Any],
+        real_app_node: dict[str, Any],
+        duration: float,
+    ) -> None:
         node['real_app_node'] = real_app_node
+        self.tracer.record('launch', node['app_id'], duration)
+        self.history.add(node['app_id'], duration)
 
-    def focus(self, sock: socket, node: dict[str, Any]) -> None:
+    def focus(self, plan: CommandPlan, node: dict[str, Any]) -> None:
         real_app_node = node.get('real_app_node', None)
         if real_app_node is None:
             print("Error: can't find real app node. Exiting.")
             sys.exit(1)
-        con_id = real_app_node['id']
-        res = command(sock, f'[con_id={con_id}] focus')
-        print('Focus result:', res)
+        plan.add('focus', real_app_node['id'], key=('Focus', node))
 
     def resize_real_app_nodes(
         self,
-        sock: socket,
+        plan: CommandPlan,
         subtree: dict[str, Any],
     ) -> None:
         for node in subtree['nodes']:
@@ -146,13 +191,13 @@ class WorkspaceManager:
                 real_app_node = app_node['real_app_node']
                 con_id = real_app_node['id']
                 width, height = self.get_scaled_size(app_node)
-                res = command(
-                    sock,
-                    f'[con_id={con_id}] resize set {width} px {height} px',
+                plan.add(
+                    f'resize set {width} px {height} px',
+                    con_id,
+                    key=('Resize', app_node),
                 )
-                print('Resize result:', res)
         for node in subtree['nodes']:
-            self.resize_real_app_nodes(sock, node)
+            self.resize_real_app_nodes(plan, node)
 
     def get_and_remember_app(
         self,
@@ -187,19 +232,20 @@ class WorkspaceManager:
         self,
         node: dict[str, Any],
     ) -> dict[str, Any] | None:
-        if 'app_node' in node:
-            return cast(dict[str, Any], node['app_node'])
-        elif 'parent' in node:
-            return self.find_parent_app_node(node['parent'])
-        else:
+        if self.layout_index is None:
             return None
-
-    def set_parents(self, subtree: dict[str, Any]) -> None:
-        for node in subtree['nodes']:
-            node['parent'] = subtree
-            self.set_parents(node)
-
-    def traverse(self, sock: socket, parent: dict[str, Any]) -> Any:
+        parent: dict[str, Any] | None = node
+        while parent is not None:
+            if 'app_node' in parent:
+                return cast(dict[str, Any], parent['app_node'])
+            parent = self.layout_index.parent(parent)
+        return None
+
+    def traverse(
+        self,
+        parent: dict[str, Any],
+        steps: list[tuple[str, dict[str, Any]]],
+    ) -> list[tuple[str, dict[str, Any]]]:
         nodes = parent['nodes']
         app_nodes = []
         for node in nodes:
@@ -211,23 +257,193 @@ class WorkspaceManager:
             focus_node = self.find_parent_app_node(parent)
             if focus_node:
                 # print('focus', focus_node['app_id'])
-                self.focus(sock, focus_node)
+                steps.append(('focus', focus_node))
 
         if 'app_id' not in parent:
             # print('split', parent['orientation'])
-            self.split(sock, parent)
+            steps.append(('split', parent))
         for app_node in app_nodes:
             # print('launch', app_node['app_id'])
-            self.launch(sock, app_node)
+            steps.append(('launch', app_node))
         for node in nodes:
-            self.traverse(sock, node)
+            self.traverse(node, steps)
+        return steps
+
+    def run_sequential(
+        self,
+        sock: socket | None,
+        sub_sock: socket | None,
+        steps: list[tuple[str, dict[str, Any]]],
+        workspace_name: str,
+    ) -> None:
+        # the commands between two launches are sent as one message
+        plan = CommandPlan(self.dry_run)
+        plan.add(f'workspace {quote(workspace_name)}', key=('Workspace', {}))
+        for step, node in steps:
+            if step == 'focus':
+                self.focus(plan, node)
+            elif step == 'split':
+                self.split(plan, node)
+            elif step == 'launch':
+                self.run_plan(sock, plan)
+                self.launch(sub_sock, node)
+        self.run_plan(sock, plan)
+
+    def match_window(
+        self,
+        container: dict[str, Any],
+        pending: list[tuple[dict[str, Any], Popen[bytes]]],
+    ) -> dict[str, Any] | None:
+        # the shell started by run_detached usually execs the app,
+        # so the pid is the most precise key, it tells apart nodes
+        # with the same app_id and different args
+        pid = container.get('pid', None)
+        for i, (node, proc) in enumerate(pending):
+            if proc.pid == pid:
+                return pending.pop(i)[0]
+        # otherwise the first pending node with the same app_id in the
+        # launch order
+        app_id = container.get('app_id', None)
+        if app_id is None:
+            app_id = container.get('window_properties', {}).get('class')
+        for i, (node, proc) in enumerate(pending):
+            if node['app_id'] == app_id:
+                return pending.pop(i)[0]
+        return None
+
+    def launch_all(
+        self,
+        sub_sock: socket | None,
+        app_nodes: list[dict[str, Any]],
+    ) -> None:
+        if sub_sock is None:
+            for node in app_nodes:
+                self.launch(sub_sock, node)
+            return
+        pending = []
+        start = time.perf_counter()
+        for node in app_nodes:
+            cmd = self.get_launch_cmd(node)
+            print('Launching app:', cmd)
+            pending.append((node, self.run_detached(cmd)))
+        # the apps start at the same time, so the slowest one of them
+        # sets the deadline for all
+        deadline = time.time() + max(
+            (self.history.deadline(n['app_id']) for n in app_nodes),
+            default=self.LAUNCH_TIMOUT_SECONDS,
+        )
+        while len(pending):
+            real_app_node = self.wait_new_window(
+                sub_sock, deadline - time.time())
+            if real_app_node is None:
+                for n, _ in pending:
+                    self.tracer.record(
+                        'timeout', n['app_id'], time.perf_counter() - start)
+                apps = ', '.join(n['app_id'] for n, _ in pending)
+                print(f'Launching apps takes too long: {apps}. Exiting.')
+                self.finish()
+                sys.exit(1)
+            node = self.match_window(real_app_node, pending)
+            if node is None:
+                print('Skipping unknown window:', real_app_node['id'])
+                continue
+            self.mapped(node, real_app_node, time.perf_counter() - start)
 
-    def load_workspace(self, load_path: str) -> None:
+    def place(
+        self,
+        plan: CommandPlan,
+        node: dict[str, Any],
+        workspace_name: str,
+        is_first: bool,
+    ) -> None:
+        con_id = node['real_app_node']['id']
+        if is_first:
+            plan.add(
+                f'move container to workspace {quote(workspace_name)}',
+                con_id,
+                key=('Place', node),
+            )
+        else:
+            # a container moved to a mark on a view becomes its next
+            # sibling, the same spot where a new window would be mapped
+            plan.add(f'mark --add {self.ANCHOR_MARK}', key=('Mark', node))
+            plan.add(
+                f'move container to mark {self.ANCHOR_MARK}',
+                con_id,
+                key=('Place', node),
+            )
+        plan.add('focus', con_id, key=('Focus', node))
+
+    def run_concurrent(
+        self,
+        sock: socket | None,
+        sub_sock: socket | None,
+        steps: list[tuple[str, dict[str, Any]]],
+        workspace_name: str,
+    ) -> None:
+        # all the apps are mapped on a staging workspace at once, then
+        # they are moved one by one to the places where the sequential
+        # mode would have launched them, the whole placement is a single
+        # message since every window already exists
+        plan = CommandPlan(self.dry_run)
+        plan.add(
+            f'workspace {quote(self.STAGING_WORKSPACE)}',
+            key=('Staging workspace', {}),
+        )
+        self.run_plan(sock, plan)
+        self.launch_all(sub_sock, [n for s, n in steps if s == 'launch'])
+        self.add_placement(plan, steps, workspace_name)
+        self.run_plan(sock, plan)
+
+    def add_placement(
+        self,
+        plan: CommandPlan,
+        steps: list[tuple[str, dict[str, Any]]],
+        workspace_name: str,
+    ) -> None:
+        plan.add(f'workspace {quote(workspace_name)}', key=('Workspace', {}))
+        is_first = True
+        for step, node in steps:
+            if step == 'focus':
+                self.focus(plan, node)
+            elif step == 'split':
+                self.split(plan, node)
+            elif step == 'launch':
+                self.place(plan, node, workspace_name, is_first)
+                is_first = False
+        plan.add(f'unmark {self.ANCHOR_MARK}', key=('Unmark', {}))
+
+    def get_target_workspaces(
+        self, sock: socket,
+    ) -> tuple[int, dict[str, Any], dict[str, dict[str, int]]]:
+        workspaces = self.query(sock, MessageType.GET_WORKSPACES)
+        num = 0
+        current_workspace: dict[str, Any] | None = None
+        output_rects = {}
+        for w in workspaces:
+            num = w['num'] if num < w['num'] else num
+            current_workspace = w
+            output_rects[w['output']] = w['rect']
+        if current_workspace is None:
+            print('Could not find current workspace')
+            sys.exit(1)
+        return num, current_workspace, output_rects
+
+    def subscribe(self) -> socket:
+        # subscribe before creating any windows so that no window::new
+        # event is missed between spawning an app and waiting for it
+        subscription = subscribe_window()
+        if subscription is None:
+            print('Could not subscribe to window events')
+            sys.exit(1)
+        return subscription[0]
+
+    def load_workspace(self, load_path: str, concurrent: bool) -> None:
         if not os.path.isfile(load_path):
             print(f'The specified file {load_path} does not exist')
             sys.exit(1)
         workspace_con = None
-        with open(load_path, 'r') as f:
+        with open(load_path, 'r') as f, self.tracer.span('parse', 'layout'):
             workspace_con = json.load(f)
         if workspace_con is None:
             print('Could not load JSON')
@@ -238,35 +454,166 @@ class WorkspaceManager:
 
         workspace_name = workspace_con['name']
         new_name = re.sub('^[0-9]+', '', workspace_name)
-        sock = get_socket()
-        workspaces = get_workspaces(sock)
-        num = 0
-        current_workspace: dict[str, Any] | None = None
-        for w in workspaces:
-            num = w['num'] if num < w['num'] else num
-            current_workspace = w
-        if current_workspace is None:
-            print('Could not find current workspace')
-            sys.exit(1)
-
-        res = command(sock, 'workspace {}'.format(str(num + 1) + new_name))
-        print('Create workspace result:', res)
-
         self.cwd = os.path.dirname(os.path.realpath(load_path))
-
         self.layout_rect = workspace_con['rect']
+
+        if self.dry_run:
+            # nothing is sent to the compositor, the layout is scaled to
+            # itself and the saved con ids are used in the commands, N
+            # stands for the number of the new workspace
+            self.workspace_rect = self.layout_rect
+            self.restore(
+                None, None, workspace_con, 'N' + new_name, concurrent)
+            return
+
+        sock = get_socket()
+        num, current_workspace, _ = self.get_target_workspaces(sock)
         self.workspace_rect = cast(dict[str, int], current_workspace['rect'])
-        self.set_parents(workspace_con)
-        self.traverse(sock, workspace_con)
-        self.resize_real_app_nodes(sock, workspace_con)
+        sub_sock = self.subscribe()
+        target_name = str(num + 1) + new_name
+        self.restore(sock, sub_sock, workspace_con, target_name, concurrent)
+        sub_sock.close()
+
+    def restore(
+        self,
+        sock: socket | None,
+        sub_sock: socket | None,
+        workspace_con: dict[str, Any],
+        workspace_name: str,
+        concurrent: bool,
+    ) -> None:
+        steps = self.get_steps(workspace_con)
+        if concurrent:
+            self.run_concurrent(sock, sub_sock, steps, workspace_name)
+        else:
+            self.run_sequential(sock, sub_sock, steps, workspace_name)
+        plan = CommandPlan(self.dry_run)
+        self.resize_real_app_nodes(plan, workspace_con)
+        self.run_plan(sock, plan)
+
+    def get_steps(
+        self, workspace_con: dict[str, Any],
+    ) -> list[tuple[str, dict[str, Any]]]:
+        self.layout_index = TreeIndex(workspace_con)
+        # the con ids of the stored layouts start from 1 in each of them
+        self.extracted_app_con_ids = []
+        return self.traverse(workspace_con, [])
+
+    def save_session(self, session_name: str) -> None:
+        sock = get_socket()
+        entries = snapshots.save_session(
+            session_name, self.query(sock, MessageType.GET_TREE))
+        for e in entries:
+            print(f'Saved {e["name"]} on {e["output"]}: {e["layout"]}')
+        print(f'Saved session {session_name} to {snapshots.STORE_DIR}')
+
+    def list_sessions(self) -> None:
+        sessions = snapshots.read_index()
+        for name, session in sorted(sessions.items()):
+            saved = time.strftime(
+                '%Y-%m-%d %H:%M', time.localtime(session['saved']))
+            workspaces = ', '.join(
+                f'{e["name"]} ({e["apps"]})' for e in session['workspaces'])
+            print(f'{name}\t{saved}\t{workspaces}')
+
+    def load_session(self, session_name: str) -> None:
+        session = snapshots.load_session(session_name)
+        if session is None:
+            print(f'No session {session_name} found')
+            sys.exit(1)
+
+        sock = None
+        sub_sock = None
+        num = 0
+        output_rects: dict[str, dict[str, int]] = {}
+        current_rect = None
+        if not self.dry_run:
+            sock = get_socket()
+            num, current_workspace, output_rects = (
+                self.get_target_workspaces(sock))
+            current_rect = current_workspace['rect']
+            sub_sock = self.subscribe()
+
+        restores = []
+        for i, (entry, workspace_con) in enumerate(session):
+            new_name = re.sub('^[0-9]+', '', entry['name'])
+            target_name = str(num + i + 1) + new_name
+            steps = self.get_steps(workspace_con)
+            restores.append((entry, workspace_con, steps, target_name))
+
+        # the apps of all the workspaces are launched at once, the windows
+        # of a workspace don't wait for the ones of the other workspaces
+        plan = CommandPlan(self.dry_run)
+        plan.add(
+            f'workspace {quote(self.STAGING_WORKSPACE)}',
+            key=('Staging workspace', {}),
+        )
+        self.run_plan(sock, plan)
+        self.launch_all(sub_sock, [
+            n for _, _, steps, _ in restores for s, n in steps
+            if s == 'launch'
+        ])
+
+        for entry, workspace_con, steps, target_name in restores:
+            self.add_placement(plan, steps, target_name)
+            output = entry['output']
+            if output in output_rects:
+                plan.add(
+                    f'move workspace to output {quote(output)}',
+                    key=('Output', {}),
+                )
+            self.layout_rect = workspace_con['rect']
+            self.workspace_rect = output_rects.get(
+                output, current_rect or self.layout_rect)
+            self.resize_real_app_nodes(plan, workspace_con)
+            self.run_plan(sock, plan)
+        if sub_sock is not None:
+            sub_sock.close()
+
+    def finish(self) -> None:
+        if not self.dry_run and self.tracer.records:
+            self.history.save()
+        if self.tracer.path is not None:
+            self.tracer.write()
+            self.tracer.summary()
 
     def main(self) -> None:
         parser = argparse.ArgumentParser()
         parser.add_argument('--workspace')
         parser.add_argument('--save')
         parser.add_argument('--load')
+        parser.add_argument(
+            '--save-session',
+            help='save all the workspaces under the name',
+        )
+        parser.add_argument(
+            '--load-session',
+            help='restore all the workspaces saved under the name',
+        )
+        parser.add_argument(
+            '--list',
+            action='store_true',
+            help='list the saved sessions',
+        )
+
+        parser.add_argument(
+            '--concurrent',
+            action='store_true',
+            help='launch all the apps at once and arrange them afterwards',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='print the commands instead of sending them',
+        )
+        parser.add_argument(
+            '--trace',
+            help='write the timings of the steps to the JSON lines file',
+        )
 
         args = parser.parse_args()
+        self.dry_run = args.dry_run
+        self.tracer.path = args.trace
 
         save_path = args.save
         load_path = args.load
@@ -274,13 +621,29 @@ class WorkspaceManager:
 
         if save_path:
             self.save_workspace(save_path, workspace_name)
+            self.finish()
             sys.exit(0)
 
         if load_path:
-            self.load_workspace(load_path)
+            self.load_workspace(load_path, args.concurrent)
+            self.finish()
+            sys.exit(0)
+
+        if args.save_session:
+            self.save_session(args.save_session)
+            self.finish()
+            sys.exit(0)
+
+        if args.load_session:
+            self.load_session(args.load_session)
+            self.finish()
+            sys.exit(0)
+
+        if args.list:
+            self.list_sessions()
             sys.exit(0)
 
-        print('Neither save or load files specified.')
+        print('Neither save or load files nor sessions specified.')
         sys.exit(1)
 
 
@@ -1,14 +1,20 @@
-from typing import Any, Callable
+from typing import Any, AsyncIterator, Callable
+from collections import deque
+from dataclasses import dataclass
 from enum import Enum
+from itertools import chain
+from weakref import WeakKeyDictionary
 import os
 import socket
 import struct
 import json
+import asyncio
 
 
 MAGIC = 'i3-ipc'
 HEADER = '=%dsII' % len(MAGIC.encode('utf-8'))
 HEADER_SIZE = struct.calcsize(HEADER)
+READ_BUFFER_SIZE = 64 * 1024
 
 SCRATCH_NAME = '__i3_scratch'
 
@@ -63,13 +69,84 @@ def unpack(data: bytes) -> str:
     return payload.decode('utf-8', 'replace')
 
 
+class FrameReader:
+    """Reads i3-ipc messages from a socket into a reusable buffer.
+
+    The socket is read with recv_into as much as the buffer can take,
+    bytes past the end of a message are kept for the next one, so back
+    to back events are not lost and a read interrupted by a timeout can
+    be resumed. The buffer only grows when a message does not fit.
+    """
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        size: int = READ_BUFFER_SIZE,
+    ) -> None:
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def fill(self, size: int) -> bool:
+        while self.end - self.start < size:
+            if self.start + size > len(self.buffer):
+                pending = self.end - self.start
+                source = memoryview(self.buffer)[self.start:self.end]
+                if size > len(self.buffer):
+                    self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+                memoryview(self.buffer)[:pending] = source
+                self.start = 0
+                self.end = pending
+            received = self.sock.recv_into(memoryview(self.buffer)[self.end:])
+            if received == 0:
+                return False
+            self.end += received
+        return True
+
+    def read_frame(self) -> tuple[int, str] | None:
+        if not self.fill(HEADER_SIZE):
+            return None
+        msg_magic, msg_length, msg_type = struct.unpack_from(
+            HEADER, self.buffer, self.start)
+        if msg_magic != MAGIC.encode('utf-8'):
+            raise ValueError('Invalid i3-ipc message header')
+        if not self.fill(HEADER_SIZE + msg_length):
+            return None
+        payload_start = self.start + HEADER_SIZE
+        payload_end = payload_start + msg_length
+        payload = str(
+            memoryview(self.buffer)[payload_start:payload_end],
+            'utf-8',
+            'replace',
+        )
+        if payload_end == self.end:
+            self.start = self.end = 0
+        else:
+            self.start = payload_end
+        return msg_type, payload
+
+
+_readers: WeakKeyDictionary[socket.socket, FrameReader] = WeakKeyDictionary()
+
+
+def get_reader(sock: socket.socket) -> FrameReader:
+    reader = _readers.get(sock, None)
+    if reader is None:
+        reader = FrameReader(sock)
+        _readers[sock] = reader
+    return reader
+
+
+def read_frame(sock: socket.socket) -> tuple[int, str]:
+    frame = get_reader(sock).read_frame()
+    if frame is None:
+        raise ConnectionError('The IPC socket is closed')
+    return frame
+
+
 def read(sock: socket.socket) -> Any:
-    data = sock.recv(14)
-    msg_magic, msg_length, msg_type = unpack_header(data)
-    msg_size = HEADER_SIZE + msg_length
-    while len(data) < msg_size:
-        data += sock.recv(msg_length)
-    payload = unpack(data)
+    _, payload = read_frame(sock)
     return json.loads(payload)
 
 
@@ -108,6 +185,62 @@ def command(sock: socket.socket, cmd: str) -> Any:
     return read(sock)
 
 
+class CommandPlan:
+    """Collects commands and sends them as a single COMMAND message.
+
+    Consecutive commands with the same con_id share one criteria and are
+    chained with ',', everything else is separated with ';' so that the
+    criteria of one group does not leak into the next one. The reply of
+    sway has an entry per command, which is mapped back to the keys the
+    commands were added with. Commands after an invalid one are not run by sway
+    and get None as the result.
+    """
+
+    def __init__(self, dry_run: bool = False) -> None:
+        self.dry_run = dry_run
+        self.commands: list[tuple[int | None, str, Any]] = []
+
+    def __len__(self) -> int:
+        return len(self.commands)
+
+    def add(self, cmd: str, con_id: int | None = None, key: Any = None) -> None:
+        self.commands.append((con_id, cmd, key))
+
+    def compile(self) -> str:
+        groups: list[str] = []
+        prev_con_id: int | None = None
+        for con_id, cmd, _ in self.commands:
+            if groups and con_id is not None and con_id == prev_con_id:
+                groups[-1] += ', ' + cmd
+            elif con_id is None:
+                groups.append(cmd)
+            else:
+                groups.append(f'[con_id={con_id}] {cmd}')
+            prev_con_id = con_id
+        return '; '.join(groups)
+
+    def execute(self, sock: socket.socket | None) -> list[tuple[Any, Any]]:
+        if not self.commands:
+            return []
+        payload = self.compile()
+        replies: list[Any] = []
+        if self.dry_run:
+            print('Plan:', payload)
+        elif sock is not None:
+            replies = command(sock, payload)
+        results = [
+            (key, replies[i] if i < len(replies) else None)
+            for i, (_, _, key) in enumerate(self.commands)
+        ]
+        self.commands = []
+        return results
+
+
+def quote(value: str) -> str:
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
 def subscribe_window() -> tuple[socket.socket, Any] | None:
     sub_sock = get_socket()
     if sub_sock is None:
@@ -117,11 +250,79 @@ def subscribe_window() -> tuple[socket.socket, Any] | None:
     return sub_sock, [read(sub_sock)]
 
 
+class TreeIndex:
+    """Lookup tables over a GET_TREE reply, built in a single pass.
+
+    Every container is indexed by id, together with its parent and the
+    workspace it belongs to. Apps are grouped by app_id, or by the window
+    class for xwayland windows.
+    """
+
+    def __init__(self, tree: dict[str, Any]) -> None:
+        self.root = tree
+        self.nodes: dict[int, dict[str, Any]] = {}
+        self.parents: dict[int, dict[str, Any]] = {}
+        self.node_workspaces: dict[int, dict[str, Any]] = {}
+        self.apps: dict[str, list[dict[str, Any]]] = {}
+        self.workspaces: list[dict[str, Any]] = []
+        self.workspace_names: dict[str, dict[str, Any]] = {}
+        self.focused_path: list[dict[str, Any]] = []
+
+        focused = None
+        stack: list[tuple[dict[str, Any], dict[str, Any] | None]] = [
+            (tree, None),
+        ]
+        while stack:
+            node, workspace = stack.pop()
+            con_id = node['id']
+            self.nodes[con_id] = node
+            if node['type'] == 'workspace':
+                workspace = node
+                self.workspaces.append(node)
+                self.workspace_names[node['name']] = node
+            if workspace is not None:
+                self.node_workspaces[con_id] = workspace
+            if node.get('focused', False):
+                focused = node
+            app_id = node.get('app_id', None)
+            if app_id is None:
+                app_id = node.get('window_properties', {}).get('class')
+            if app_id is not None:
+                self.apps.setdefault(app_id, []).append(node)
+            children = chain(node['nodes'], node.get('floating_nodes', []))
+            # reversed to keep the document order of the lists
+            for child in reversed(list(children)):
+                self.parents[child['id']] = node
+                stack.append((child, workspace))
+
+        while focused is not None:
+            self.focused_path.append(focused)
+            focused = self.parents.get(focused['id'], None)
+        self.focused_path.reverse()
+
+    @property
+    def focused(self) -> dict[str, Any] | None:
+        return self.focused_path[-1] if self.focused_path else None
+
+    @property
+    def focused_workspace(self) -> dict[str, Any] | None:
+        focused = self.focused
+        if focused is None:
+            return None
+        return self.node_workspaces.get(focused['id'], None)
+
+    def parent(self, node: dict[str, Any]) -> dict[str, Any] | None:
+        return self.parents.get(node['id'], None)
+
+    def workspace(self, node: dict[str, Any]) -> dict[str, Any] | None:
+        return self.node_workspaces.get(node['id'], None)
+
+
 def find_con_parent_workspace(
     parent: dict[str, Any],
     callback_fn: Callable[[dict[str, Any]], bool],
 ) -> tuple[dict[str, Any] | None, dict[str, Any] | None, dict[str, Any] | None]:
-    nodes = parent['nodes'] + parent['floating_nodes']
+    nodes = chain(parent['nodes'], parent['floating_nodes'])
     workspace = None
     for n in nodes:
         if n['type'] == 'workspace':
@@ -139,10 +340,170 @@ def find_nodes(
     parent: dict[str, Any],
     callback_fn: Callable[[dict[str, Any]], bool],
 ) -> list[dict[str, Any]]:
-    nodes = parent['nodes'] + parent['floating_nodes']
+    nodes = chain(parent['nodes'], parent['floating_nodes'])
     apps = []
     for n in nodes:
         if callback_fn(n):
             apps.append(n)
         apps.extend(find_nodes(n, callback_fn))
     return apps
+
+
+@dataclass
+class Event:
+    """An event of AsyncConnection.subscribe(), the type is the name of
+    the event in the protocol ("window", "workspace", ...), the payload
+    is the parsed JSON.
+    """
+    type: str
+    change: str | None
+    payload: Any
+
+
+class AsyncConnection:
+    """asyncio client for the sway/i3 IPC.
+
+    Replies come in the order of the requests, so several requests can be
+    in flight on the command socket, each one waits for its future in a
+    FIFO. Events are read from a second socket into a bounded queue, the
+    reading stops while the queue is full, so a slow consumer is not
+    flooded with events.
+    """
+
+    def __init__(self, path: str | None = None, max_events: int = 256):
+        self.path = path or socket_path()
+        self.max_events = max_events
+        self.writer: asyncio.StreamWriter | None = None
+        self.pending: deque[asyncio.Future[Any]] = deque()
+        self.reader_task: asyncio.Task[None] | None = None
+        self.event_writers: list[asyncio.StreamWriter] = []
+
+    async def connect(self) -> None:
+        if self.path is None:
+            raise ConnectionError('No IPC socket path')
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.reader_task = asyncio.create_task(self.read_replies(reader))
+
+    async def close(self) -> None:
+        for writer in [self.writer] + self.event_writers:
+            if writer is not None:
+                writer.close()
+                await writer.wait_closed()
+        if self.reader_task is not None:
+            await self.reader_task
+
+    async def read_message(
+        self,
+        reader: asyncio.StreamReader,
+    ) -> tuple[int, str] | None:
+        try:
+            header = await reader.readexactly(HEADER_SIZE)
+            msg_magic, msg_length, msg_type = struct.unpack(HEADER, header)
+            if msg_magic != MAGIC.encode('utf-8'):
+                raise ValueError('Invalid i3-ipc message header')
+            payload = await reader.readexactly(msg_length)
+        except asyncio.IncompleteReadError:
+            return None
+        return msg_type, payload.decode('utf-8', 'replace')
+
+    async def read_replies(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                message = await self.read_message(reader)
+                if message is None:
+                    break
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_result(json.loads(message[1]))
+        finally:
+            # the requests in flight fail with the socket, the replies of
+            # a broken stream can't be matched to them anymore
+            while self.pending:
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError('The IPC socket is closed'))
+
+    def request(
+        self,
+        msg_type: MessageType,
+        payload: str = '',
+    ) -> asyncio.Future[Any]:
+        if self.writer is None:
+            raise ConnectionError('Not connected')
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.writer.write(pack(msg_type, payload))
+        return future
+
+    async def command(self, cmd: str) -> Any:
+        return await self.request(MessageType.COMMAND, cmd)
+
+    async def get_tree(self) -> Any:
+        return await self.request(MessageType.GET_TREE)
+
+    async def get_workspaces(self) -> Any:
+        return await self.request(MessageType.GET_WORKSPACES)
+
+    async def get_outputs(self) -> Any:
+        return await self.request(MessageType.GET_OUTPUTS)
+
+    async def get_version(self) -> Any:
+        return await self.request(MessageType.GET_VERSION)
+
+    async def subscribe(self, names: list[str]) -> AsyncIterator[Event]:
+        """Subscribes to the events by their names ("window", "workspace",
+        ...) on a socket of its own and yields them.
+        """
+        if self.path is None:
+            raise ConnectionError('No IPC socket path')
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        self.event_writers.append(writer)
+        writer.write(pack(MessageType.SUBSCRIBE, json.dumps(names)))
+        queue: asyncio.Queue[Event | Exception | None] = asyncio.Queue(
+            self.max_events)
+
+        async def read_events() -> None:
+            reply = await self.read_message(reader)
+            if reply is None or not json.loads(reply[1])['success']:
+                return
+            while True:
+                message = await self.read_message(reader)
+                if message is None:
+                    return
+                msg_type, payload = message
+                try:
+                    event_type = EventType(1 << (msg_type & 0x7f))
+                except ValueError:
+                    # the events of newer versions, bar_state_update of
+                    # sway has the bit 20
+                    continue
+                data = json.loads(payload)
+                change = data.get('change', None)
+                # waits while the queue is full and leaves the rest in
+                # the socket buffer
+                await queue.put(Event(event_type.name.lower(), change, data))
+
+        async def read_until_closed() -> None:
+            # the consumer stops on None or raises the error of the
+            # reading, it would wait for the next event forever otherwise
+            try:
+                await read_events()
+            except Exception as e:
+                await queue.put(e)
+            else:
+                await queue.put(None)
+
+        task = asyncio.create_task(read_until_closed())
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+        finally:
+            task.cancel()
+            writer.close()
+            self.event_writers.remove(writer)
@@ -0,0 +1,111 @@
+from typing import Any, Iterator
+import os
+import json
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+
+
+HOME = os.environ.get('HOME', '')
+CACHE_DIR = os.environ.get('XDG_CACHE_HOME', None) or os.path.join(
+    HOME, '.cache')
+HISTORY_PATH = os.path.join(CACHE_DIR, 'srws', 'launch_history.json')
+
+
+class Tracer:
+    """Collects the durations of the restore steps, the records are
+    written as JSON lines to the trace file when there's one.
+    """
+
+    def __init__(self, path: str | None = None) -> None:
+        self.path = path
+        self.started = time.perf_counter()
+        self.records: list[dict[str, Any]] = []
+
+    def record(self, kind: str, name: str, duration: float, **fields: Any) -> None:
+        self.records.append({
+            'kind': kind,
+            'name': name,
+            'start': round(time.perf_counter() - duration - self.started, 6),
+            'duration': round(duration, 6),
+            **fields,
+        })
+
+    @contextmanager
+    def span(self, kind: str, name: str, **fields: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(kind, name, time.perf_counter() - start, **fields)
+
+    def write(self) -> None:
+        if self.path is None:
+            return
+        with open(self.path, 'w') as f:
+            for r in self.records:
+                f.write(json.dumps(r) + '\n')
+
+    def summary(self) -> None:
+        groups: dict[tuple[str, str], list[float]] = {}
+        for r in self.records:
+            groups.setdefault((r['kind'], r['name']), []).append(r['duration'])
+        header = ('kind', 'name', 'count', 'total ms', 'mean ms', 'max ms')
+        rows = [header]
+        for (kind, name), durations in groups.items():
+            rows.append((
+                kind,
+                name,
+                str(len(durations)),
+                f'{sum(durations) * 1000:.1f}',
+                f'{statistics.mean(durations) * 1000:.1f}',
+                f'{max(durations) * 1000:.1f}',
+            ))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        for row in rows:
+            print('  '.join(c.ljust(w) for c, w in zip(row, widths)))
+        total = time.perf_counter() - self.started
+        print(f'total {total * 1000:.1f} ms')
+
+
+class LaunchHistory:
+    """Keeps the recent spawn-to-map times of every app_id between runs
+    and derives the time to wait for a window of the app from them. The
+    default is the lower bound, a missed deadline aborts the restore, so
+    the history only gives the slow apps more time.
+    """
+
+    SAMPLES = 20
+    MAX_DEADLINE = 60.0
+
+    def __init__(self, default: float, path: str = HISTORY_PATH) -> None:
+        self.default = default
+        self.path = path
+        self.samples: dict[str, list[float]] = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    self.samples = dict(json.load(f))
+            except ValueError:
+                self.samples = {}
+
+    def add(self, app_id: str, duration: float) -> None:
+        samples = self.samples.setdefault(app_id, [])
+        samples.append(round(duration, 3))
+        del samples[:-self.SAMPLES]
+
+    def deadline(self, app_id: str) -> float:
+        samples = self.samples.get(app_id, None)
+        if not samples:
+            return self.default
+        # twice the slowest recent start, a cold cache may be that slow
+        deadline = 2 * max(samples) + 1
+        return min(self.MAX_DEADLINE, max(self.default, deadline))
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.samples, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+A persistent connection to the i3/sway IPC socket for the commands of the
+applets, it costs a write and a read per command instead of a fork of
+i3-msg. The socket is opened on the first command and opened again after
+i3 or sway restarts. The messages are framed by sway_ipc of
+sway_restore_workspace, the framing is the same for i3.
+"""
+
+import os
+import json
+import socket
+import subprocess
+import threading
+
+from sway_restore_workspace.sway_ipc import FrameReader, MessageType, pack
+
+
+def get_socket_path():
+    path = os.environ.get('I3SOCK') or os.environ.get('SWAYSOCK')
+    if path:
+        return path
+    for wm in ('i3', 'sway'):
+        try:
+            return subprocess.check_output(
+                [wm, '--get-socketpath'], universal_newlines=True,
+                stderr=subprocess.DEVNULL).strip()
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    return None
+
+
+class IPCClient(object):
+    def __init__(self, socket_path=None, timeout=2.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # the path is looked up again, a restarted i3 has a new socket
+        path = self.socket_path or get_socket_path()
+        if not path:
+            raise ConnectionError('No i3/sway IPC socket')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.reader = FrameReader(sock)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            self.reader = None
+
+    def send(self, message):
+        # the socket of a window manager which restarted fails on the
+        # send, before the message can run, so it's sent once more on a
+        # new socket
+        for retry in (False, True):
+            try:
+                if self.sock is None:
+                    self.connect()
+                self.sock.sendall(message)
+                return
+            except socket.timeout:
+                self.close()
+                raise
+            except OSError:
+                self.close()
+                if retry:
+                    raise
+
+    def message(self, msg_type, payload):
+        """
+        Sends a message and returns the parsed reply. Only a failed send
+        is retried, once the message went through a lost reply or a
+        timeout is raised as the message may have run.
+        """
+        with self.lock:
+            self.send(pack(msg_type, payload))
+            try:
+                frame = self.reader.read_frame()
+            except (OSError, ValueError):
+                # the stream is out of step with the replies
+                self.close()
+                raise
+            if frame is None:
+                self.close()
+                raise ConnectionResetError('The IPC socket is closed')
+            return json.loads(frame[1])
+
+    def command(self, cmd):
+        """Runs a command, returns the success of each chained command."""
+        return [r.get('success', False)
+                for r in self.message(MessageType.COMMAND, cmd)]